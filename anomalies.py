@@ -0,0 +1,88 @@
+# Response anomaly index
+# by Mario Vilas (mvilas at gmail.com)
+#
+# Each upstream response is reduced to a fingerprint: the status code (or
+# the method, for requests sent by the server), the set of header names,
+# the body length and latency rounded to powers of two, and how the
+# connection ended. Fingerprints are counted in a bounded LRU keyed on
+# their hash, so both the cost per response and the memory used stay
+# constant no matter how long the campaign runs. The first few times a
+# fingerprint is seen it's flagged as an anomaly and the request that caused
+# it is kept (and optionally saved to disk), everything else is just counted.
+#
+# Fingerprints that fall out of the LRU are flagged again if they come back,
+# which is what we want for something that rare anyway.
+
+import os
+
+from collections import deque
+from time import time
+
+from lrucache import LRUCache
+from ringlog import log
+
+#------------------------------------------------------------------------------
+
+def bucket(value):
+    'Power of two bucket for a non negative number.'
+    return int(value).bit_length()
+
+def fingerprint(resp, latency, outcome):
+    'Compact description of a response, as a tuple.'
+    if resp is None:
+        return (None, None, (), 0, bucket(latency * 1000), outcome)
+    if resp.isResponse():
+        status, method = resp.getStatus(), None
+    else:
+        status, method = None, resp.getMethod()     # server to client request
+    names = [ name.lower() for name, value in resp ]
+    names = tuple( sorted( set(names) ) )
+    return (status, method, names, bucket( len(resp.getData()) ),
+                                            bucket(latency * 1000), outcome)
+
+class AnomalyIndex:
+    'Counts response fingerprints and flags the rare ones.'
+
+    def __init__(self, maxEntries = 0x10000, rareThreshold = 3,
+                                        maxAnomalies = 1000, directory = None):
+        self.counts         = LRUCache(maxEntries)
+        self.rareThreshold  = rareThreshold
+        self.anomalies      = deque(maxlen = maxAnomalies)
+        self.directory      = directory
+        self.observed       = 0
+        self.flagged        = 0
+
+    def observe(self, req, resp, latency, outcome):
+        'Count a response, return its count if it was flagged or None.'
+        self.observed += 1
+        fp    = fingerprint(resp, latency, outcome)
+        key   = hash(fp)
+        count = self.counts.get(key, 0) + 1
+        self.counts.put(key, count)
+        if count > self.rareThreshold:
+            return None
+        self.flag(req, fp, count)
+        return count
+
+    def flag(self, req, fp, count):
+        self.flagged += 1
+        data  = str(req)
+        entry = (time(), fp, count, data)
+        self.anomalies.append(entry)
+        log.info('ANOMALY %r seen %d times', fp, count)
+        if self.directory is not None:
+            kind = ''.join([ c for c in str(fp[0] or fp[1]) if c.isalnum() ])
+            filename = 'anomaly_%06d_%s_seen_%d' % (self.flagged, kind, count)
+            fd = open(os.path.join(self.directory, filename), 'wb')
+            try:
+                fd.write(data)
+            finally:
+                fd.close()
+        return entry
+
+    def stats(self):
+        return {
+            'observed'      : self.observed,
+            'flagged'       : self.flagged,
+            'fingerprints'  : len(self.counts),
+        }
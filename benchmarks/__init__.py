@@ -0,0 +1,2 @@
+# Benchmarks for the RTSP fuzzer
+# by Mario Vilas (mvilas at gmail.com)
@@ -0,0 +1,69 @@
+# Runs the whole benchmark suite and saves the results as JSON
+# by Mario Vilas (mvilas at gmail.com)
+#
+# The TLS handshake benchmark needs the openssl command line tool to make
+# its certificate, it's skipped when the tool is not installed.
+#
+# Run from the repository root:
+#   python -m benchmarks [-o results.json] [-d seconds] [-w workers]
+
+import sys
+import json
+import platform
+
+from optparse import OptionParser
+from time import time
+
+from benchmarks import parsers, responses, messages, loadgen
+from benchmarks import tunnel, tls, forkserver
+
+#------------------------------------------------------------------------------
+
+def main():
+    parser = OptionParser(usage = '%prog [options]')
+    parser.add_option('-o', '--output', default = 'bench_output.json',
+                      help = 'JSON file to write the results to')
+    parser.add_option('-d', '--duration', type = 'float', default = 5.0,
+                      help = 'seconds to run each load test for')
+    parser.add_option('-w', '--workers', type = 'int', default = 4,
+                      help = 'number of load generator processes')
+    parser.add_option('-p', '--path', action = 'append', dest = 'paths',
+                      help = 'only run the given load test path (repeatable)')
+    parser.add_option('--no-load', action = 'store_true', default = False,
+                      help = 'skip every benchmark that starts a server')
+    options, args = parser.parse_args()
+
+    results = {
+        'timestamp' : time(),
+        'python'    : sys.version.split()[0],
+        'platform'  : platform.platform(),
+    }
+    print 'Running parser microbenchmarks...'
+    results['parsers']   = parsers.run()
+    print 'Running response benchmarks...'
+    results['responses'] = responses.run()
+    print 'Running message memory benchmarks...'
+    results['messages']  = messages.run()
+    if not options.no_load:
+        print 'Running load tests...'
+        results['load']  = loadgen.run(options.duration, options.workers,
+                                                                options.paths)
+        print 'Running HTTP tunnel benchmarks...'
+        results['tunnel']       = tunnel.run(options.duration)
+        print 'Running TLS handshake benchmarks...'
+        try:
+            results['tls']      = tls.run()
+        except OSError:
+            print 'Skipped, the openssl command line tool was not found.'
+        print 'Running fork server benchmarks...'
+        results['forkserver']   = forkserver.run()
+
+    fd = open(options.output, 'w')
+    try:
+        json.dump(results, fd, indent = 2, sort_keys = True)
+    finally:
+        fd.close()
+    print 'Results saved to %s' % options.output
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+# Fixed message corpus used by the benchmarks
+# by Mario Vilas (mvilas at gmail.com)
+
+#------------------------------------------------------------------------------
+
+sdp = (
+    'v=0\r\n'
+    'o=- 1234567890 1 IN IP4 127.0.0.1\r\n'
+    's=Benchmark stream\r\n'
+    'i=Stand-in target session\r\n'
+    'c=IN IP4 0.0.0.0\r\n'
+    't=0 0\r\n'
+    'a=tool:rtsp-fuzzer\r\n'
+    'a=range:npt=0-\r\n'
+    'm=video 0 RTP/AVP 96\r\n'
+    'a=rtpmap:96 H264/90000\r\n'
+    'a=control:trackID=1\r\n'
+    'm=audio 0 RTP/AVP 97\r\n'
+    'a=rtpmap:97 MPEG4-GENERIC/44100/2\r\n'
+    'a=control:trackID=2\r\n'
+)
+
+requests = {
+    'OPTIONS' : (
+        'OPTIONS rtsp://127.0.0.1:554/stream RTSP/1.0\r\n'
+        'CSeq: 1\r\n'
+        'User-Agent: BenchmarkClient\r\n'
+        '\r\n'
+    ),
+    'DESCRIBE' : (
+        'DESCRIBE rtsp://127.0.0.1:554/stream RTSP/1.0\r\n'
+        'CSeq: 2\r\n'
+        'Accept: application/sdp\r\n'
+        'Session: 12345678\r\n'
+        'User-Agent: BenchmarkClient\r\n'
+        '\r\n'
+    ),
+    'SETUP' : (
+        'SETUP rtsp://127.0.0.1:554/stream/trackID=1 RTSP/1.0\r\n'
+        'CSeq: 3\r\n'
+        'Transport: RTP/AVP;unicast;client_port=5000-5001\r\n'
+        'User-Agent: BenchmarkClient\r\n'
+        '\r\n'
+    ),
+    'PLAY' : (
+        'PLAY rtsp://127.0.0.1:554/stream RTSP/1.0\r\n'
+        'CSeq: 4\r\n'
+        'Session: 12345678\r\n'
+        'Range: npt=0.000-\r\n'
+        'User-Agent: BenchmarkClient\r\n'
+        '\r\n'
+    ),
+    'TEARDOWN' : (
+        'TEARDOWN rtsp://127.0.0.1:554/stream RTSP/1.0\r\n'
+        'CSeq: 5\r\n'
+        'Session: 12345678\r\n'
+        'User-Agent: BenchmarkClient\r\n'
+        '\r\n'
+    ),
+    'HTTP_GET' : (
+        'GET /index.html HTTP/1.1\r\n'
+        'Host: 127.0.0.1\r\n'
+        'Accept: */*\r\n'
+        'Connection: close\r\n'
+        '\r\n'
+    ),
+}
+
+responses = {
+    'OPTIONS' : (
+        'RTSP/1.0 200 OK\r\n'
+        'CSeq: 1\r\n'
+        'Public: OPTIONS, DESCRIBE, SETUP, PLAY, TEARDOWN\r\n'
+        'Content-length: 0\r\n'
+        '\r\n'
+    ),
+    'DESCRIBE' : (
+        'RTSP/1.0 200 OK\r\n'
+        'CSeq: 2\r\n'
+        'Content-Base: rtsp://127.0.0.1:554/stream/\r\n'
+        'Content-Type: application/sdp\r\n'
+        'Content-length: %d\r\n'
+        '\r\n'
+        '%s'
+    ) % (len(sdp), sdp),
+}
+
+headers = (
+    'CSeq: 3\r\n'
+    'Transport: RTP/AVP;unicast;\r\n'
+    ' client_port=5000-5001\r\n'
+    'Session: 12345678\r\n'
+    'User-Agent: BenchmarkClient\r\n'
+    'X-Padding: ' + 'A' * 200 + '\r\n'
+    '\r\n'
+)
+
+# Methods sent, in order, by each load generator session.
+session = ('OPTIONS', 'DESCRIBE', 'SETUP', 'PLAY', 'TEARDOWN')
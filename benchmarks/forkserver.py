@@ -0,0 +1,84 @@
+# Target restart cost benchmark
+# by Mario Vilas (mvilas at gmail.com)
+#
+# Compares test cases per second against the stand-in target when it is
+# started from scratch for every test case, forked for every test case, and
+# forked once every 100 test cases.
+#
+# Run from the repository root:
+#   python -m benchmarks.forkserver
+
+import sys
+import subprocess
+
+from time import time
+
+from rtsp_server import Client, StreamTransport
+from harness import PythonForkServer, TargetHarness
+
+from benchmarks.loadgen import freePort, waitForPort
+from benchmarks.target import StandInServer
+
+#------------------------------------------------------------------------------
+
+def exchange(client, port, cseq):
+    url = 'rtsp://127.0.0.1:%d/stream' % port
+    req = client.buildRequest('OPTIONS', url, '', cseq)
+    return client.exchange(req)
+
+def restartRate(count):
+    'Start a new target process for each test case.'
+    start = time()
+    for i in xrange(count):
+        port    = freePort('tcp')
+        process = subprocess.Popen([sys.executable, '-m', 'benchmarks.target',
+                                                                    str(port)],
+                                   stdout = subprocess.PIPE)
+        try:
+            waitForPort('tcp', port)
+            client = Client(StreamTransport)
+            client.debugging = False
+            client.connect('127.0.0.1', port)
+            exchange(client, port, i + 1)
+            client.disconnect()
+        finally:
+            process.kill()
+            process.wait()
+    return count / (time() - start)
+
+def forkRate(count, recycleEvery):
+    'Fork the target every "recycleEvery" test cases.'
+    port    = freePort('tcp')
+    target  = StandInServer(StreamTransport, '127.0.0.1', port)
+    harness = TargetHarness(PythonForkServer(target),
+                                            recycleEvery = recycleEvery)
+    harness.start()
+    try:
+        client = Client(StreamTransport)
+        client.debugging = False
+        client.harness   = harness
+        client.connect('127.0.0.1', port)
+        start = time()
+        for i in xrange(count):
+            exchange(client, port, i + 1)
+        elapsed = time() - start
+        client.disconnect()
+    finally:
+        harness.stop()
+    return count / elapsed
+
+def run(count = 200):
+    return {
+        'restart_per_second'    : restartRate( max(1, count // 10) ),
+        'fork_per_second'       : forkRate(count, 1),
+        'fork100_per_second'    : forkRate(count, 100),
+    }
+
+def main():
+    results = run()
+    print 'restart every case   %8.1f/s' % results['restart_per_second']
+    print 'fork every case      %8.1f/s' % results['fork_per_second']
+    print 'fork every 100 cases %8.1f/s' % results['fork100_per_second']
+
+if __name__ == '__main__':
+    main()
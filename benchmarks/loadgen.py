@@ -0,0 +1,189 @@
+# Multi-process load generator
+# by Mario Vilas (mvilas at gmail.com)
+#
+# Starts the stand-in target (and optionally a proxy in front of it) in
+# separate processes, then runs a pool of worker processes that each drive
+# a Client through OPTIONS, DESCRIBE, SETUP, PLAY and TEARDOWN in a loop.
+#
+# Run from the repository root:
+#   python -m benchmarks.loadgen
+
+import socket
+
+from multiprocessing import Pool, Process
+from resource import getrusage, RUSAGE_SELF
+from time import time, sleep
+
+from metrics import Histogram, clock
+from rtsp_server import Client, Proxy, StreamTransport, DatagramTransport
+
+from benchmarks.corpus import session
+from benchmarks.target import StandInServer
+
+#------------------------------------------------------------------------------
+
+transports = {
+    'tcp' : StreamTransport,
+    'udp' : DatagramTransport,
+}
+
+# Benchmarked paths: (name, transport, proxied)
+paths = (
+    ('tcp-direct',  'tcp', False),
+    ('tcp-proxied', 'tcp', True),
+    ('udp-direct',  'udp', False),
+    ('udp-proxied', 'udp', True),
+)
+
+def freePort(kind):
+    'Ask the OS for a port number that is currently unused.'
+    if kind == 'tcp':
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    else:
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        s.bind( ('127.0.0.1', 0) )
+        return s.getsockname()[1]
+    finally:
+        s.close()
+
+def getRSS(pid):
+    'Resident set size of a process in kilobytes, or None if unknown.'
+    try:
+        for line in open('/proc/%d/status' % pid):
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+
+#------------------------------------------------------------------------------
+
+def serveForever(role, kind, port):
+    if role == 'target':
+        server = StandInServer(transports[kind], '127.0.0.1', port)
+    else:
+        server = Proxy(transports[kind], '127.0.0.1', port)
+    server.debugging = False
+    server.run()
+
+def waitForPort(kind, port, timeout = 5.0):
+    if kind != 'tcp':
+        sleep(0.2)
+        return
+    deadline = time() + timeout
+    while time() < deadline:
+        try:
+            socket.create_connection( ('127.0.0.1', port) ).close()
+            return
+        except socket.error:
+            sleep(0.05)
+    raise Exception, 'Server on port %d did not start' % port
+
+def worker( (kind, connectPort, targetPort, duration, timeout) ):
+    'Run client sessions until the time runs out, return the statistics.'
+    client = Client(transports[kind])
+    client.debugging = False
+    client.metrics   = None
+    histogram = Histogram()
+    count     = 0
+    errors    = 0
+    cseq      = 0
+    url       = 'rtsp://127.0.0.1:%d/stream' % targetPort
+    client.connect('127.0.0.1', connectPort)
+    client.connection.sock.settimeout(timeout)
+    deadline  = time() + duration
+    while time() < deadline:
+        for method in session:
+            cseq += 1
+            req = client.buildRequest(method, url, '', cseq)
+            start = clock()
+            try:
+                client.connection.write(req)
+                resp = client.connection.read()
+            except Exception:
+                errors += 1
+                client.disconnect()
+                client.connect('127.0.0.1', connectPort)
+                client.connection.sock.settimeout(timeout)
+                continue
+            histogram.record(clock() - start)
+            count += 1
+            if resp.getStatus() != '200':
+                errors += 1
+    client.disconnect()
+    return count, errors, histogram, getrusage(RUSAGE_SELF).ru_maxrss
+
+def runPath(kind, proxied, duration = 5.0, workers = 4, timeout = 2.0):
+    'Benchmark one path and return a dictionary with the results.'
+    processes  = {}
+    targetPort = freePort(kind)
+    processes['target'] = Process(target = serveForever,
+                                        args = ('target', kind, targetPort))
+    connectPort = targetPort
+    if proxied:
+        connectPort = freePort(kind)
+        processes['proxy'] = Process(target = serveForever,
+                                        args = ('proxy', kind, connectPort))
+    try:
+        for process in processes.values():
+            process.daemon = True
+            process.start()
+        waitForPort(kind, targetPort)
+        waitForPort(kind, connectPort)
+        pool = Pool(workers)
+        try:
+            args    = [ (kind, connectPort, targetPort, duration, timeout) ]
+            args    = args * workers
+            start   = time()
+            results = pool.map(worker, args)
+            elapsed = time() - start
+        finally:
+            pool.close()
+            pool.join()
+        rss = {}
+        for role, process in processes.items():
+            rss[role] = getRSS(process.pid)
+    finally:
+        for process in processes.values():
+            process.terminate()
+            process.join()
+    histogram = Histogram()
+    count     = 0
+    errors    = 0
+    clientRSS = 0
+    for c, e, h, maxrss in results:
+        count  += c
+        errors += e
+        histogram.merge(h)
+        clientRSS = max(clientRSS, maxrss)
+    return {
+        'requests'          : count,
+        'errors'            : errors,
+        'seconds'           : elapsed,
+        'throughput'        : count / elapsed,
+        'p50_us'            : histogram.percentile(50),
+        'p99_us'            : histogram.percentile(99),
+        'mean_us'           : histogram.snapshot()['mean'],
+        'workers'           : workers,
+        'rss_kb'            : rss,
+        'client_maxrss_kb'  : clientRSS,
+    }
+
+def run(duration = 5.0, workers = 4, selected = None):
+    'Benchmark every path (or only the selected ones) and return the results.'
+    results = {}
+    for name, kind, proxied in paths:
+        if selected and name not in selected:
+            continue
+        results[name] = runPath(kind, proxied, duration, workers)
+    return results
+
+def main():
+    results = run()
+    for name, kind, proxied in paths:
+        r = results[name]
+        print '%-12s %8.1f req/s  p50 %6d us  p99 %6d us  errors %d' % (
+                name, r['throughput'], r['p50_us'], r['p99_us'], r['errors'])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+# Per message memory and allocation benchmark
+# by Mario Vilas (mvilas at gmail.com)
+#
+# Measures how much memory a parsed message keeps alive, how many garbage
+# collected objects parsing one allocates, and how long parsing takes with
+# and without a MessagePool.
+#
+# Run from the repository root:
+#   python -m benchmarks.messages
+
+import gc
+import os
+import sys
+
+from resource import getrusage, RUSAGE_SELF
+from timeit import Timer
+
+from mimebased import StreamingFactory
+
+from benchmarks.corpus import requests, responses
+
+try:
+    from mimebased import MessagePool
+except ImportError:
+    MessagePool = None          # older trees, for before/after comparisons
+
+#------------------------------------------------------------------------------
+
+def slotNames(cls):
+    'Instance attribute names declared in __slots__ by a class and its bases.'
+    names = []
+    for klass in getattr(cls, '__mro__', ()):
+        slots = klass.__dict__.get('__slots__', ())
+        if isinstance(slots, str):
+            slots = (slots,)
+        for name in slots:
+            if name.startswith('__') and not name.endswith('__'):
+                name = '_%s%s' % (klass.__name__.lstrip('_'), name)
+            names.append(name)
+    return names
+
+def deepSize(obj, seen = None):
+    'Bytes used by an object and everything it references, shared or not.'
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add( id(obj) )
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += deepSize(key, seen) + deepSize(value, seen)
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            size += deepSize(item, seen)
+    if hasattr(obj, '__dict__') and not isinstance(obj, type):
+        size += deepSize(obj.__dict__, seen)
+    for name in slotNames( type(obj) ):
+        try:
+            size += deepSize(getattr(obj, name), seen)
+        except AttributeError:
+            pass
+    return size
+
+def parseAll():
+    messages = []
+    for data in requests.values() + responses.values():
+        message = StreamingFactory.parse(data)
+        message.get('Content-Length')       # what every transport read does
+        messages.append(message)
+    return messages
+
+def messageSize():
+    'Average retained bytes per parsed message.'
+    messages = parseAll()
+    return sum([ deepSize(m) for m in messages ]) / float(len(messages))
+
+def allocations():
+    'Average garbage collected objects allocated per parsed message.'
+    gc.collect()
+    gc.disable()
+    try:
+        before   = len( gc.get_objects() )
+        messages = parseAll()
+        after    = len( gc.get_objects() )
+    finally:
+        gc.enable()
+    return (after - before - 1) / float(len(messages))     # minus the list
+
+def retainedRSS(count = 100000):
+    'Resident memory per message when many of them are kept around.'
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        data = requests['DESCRIBE']
+        base = getrusage(RUSAGE_SELF).ru_maxrss
+        kept = []
+        for i in xrange(count):
+            message = StreamingFactory.parse(data)
+            message.get('CSeq')
+            kept.append(message)
+        used = getrusage(RUSAGE_SELF).ru_maxrss - base
+        os.write(write, str(used * 1024.0 / count))
+        os._exit(0)
+    os.close(write)
+    result = os.read(read, 64)
+    os.close(read)
+    os.waitpid(pid, 0)
+    return float(result)
+
+def parseTime(pool, number = 20000):
+    data = requests['DESCRIBE']
+    if pool is None:
+        def parse():
+            message = StreamingFactory.parse(data)
+            message.get('CSeq')
+    else:
+        def parse():
+            message = StreamingFactory.parse(data, pool)
+            message.get('CSeq')
+            pool.release(message)
+    return min( Timer(parse).repeat(5, number) ) / number
+
+def run():
+    results = {
+        'bytes_per_message'     : messageSize(),
+        'objects_per_message'   : allocations(),
+        'rss_per_message'       : retainedRSS(),
+        'parse_seconds'         : parseTime(None),
+        'pooled_parse_seconds'  : None,
+    }
+    if MessagePool is not None:
+        results['pooled_parse_seconds'] = parseTime( MessagePool() )
+    return results
+
+def main():
+    results = run()
+    print 'retained bytes/message  %8.1f' % results['bytes_per_message']
+    print 'gc objects/message      %8.1f' % results['objects_per_message']
+    print 'RSS bytes/message       %8.1f' % results['rss_per_message']
+    print 'parse                   %8.2f usec' % (results['parse_seconds'] * 1e6)
+    if results['pooled_parse_seconds'] is not None:
+        print 'pooled parse            %8.2f usec' % (
+                                        results['pooled_parse_seconds'] * 1e6)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+# Parser microbenchmarks
+# by Mario Vilas (mvilas at gmail.com)
+#
+# Run from the repository root:
+#   python -m benchmarks.parsers
+
+from timeit import Timer
+
+from mimebased import Headers, Message, SDPSession, StreamingFactory
+
+from benchmarks.corpus import requests, responses, headers, sdp
+
+#------------------------------------------------------------------------------
+
+def cases():
+    'Return a list of (name, callable) pairs to time.'
+    describe = requests['DESCRIBE']
+    reply    = responses['DESCRIBE']
+    parsed   = StreamingFactory.parse(describe)
+    return [
+        ('Headers',                 lambda: Headers(headers)),
+        ('Message',                 lambda: Message(describe)),
+        ('Factory.getParser',       lambda: StreamingFactory.getParser(reply)),
+        ('Factory.parse.request',   lambda: StreamingFactory.parse(describe)),
+        ('Factory.parse.response',  lambda: StreamingFactory.parse(reply)),
+        ('Factory.recursive',       lambda: StreamingFactory.recursive(reply)),
+        ('SDPSession',              lambda: SDPSession(sdp)),
+        ('Message.__str__',         lambda: str(parsed)),
+    ]
+
+def run(number = 10000, repeat = 5):
+    'Return the best time per call of each case, in seconds.'
+    results = {}
+    for name, fn in cases():
+        best = min( Timer(fn).repeat(repeat, number) )
+        results[name] = best / number
+    return results
+
+def main():
+    results = run()
+    for name in sorted(results.keys()):
+        print '%-24s %8.2f usec/call' % (name, results[name] * 1e6)
+
+if __name__ == '__main__':
+    main()
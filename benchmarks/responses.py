@@ -0,0 +1,59 @@
+# Response construction benchmark
+# by Mario Vilas (mvilas at gmail.com)
+#
+# Compares Server.buildResponse against the original implementation, which
+# set every header one at a time and called asctime() on each response.
+#
+# Run from the repository root:
+#   python -m benchmarks.responses
+
+from timeit import Timer
+from time import asctime
+
+from mimebased import StreamingFactory
+from rtsp_server import Server
+
+from benchmarks.corpus import requests
+
+#------------------------------------------------------------------------------
+
+def naiveBuildResponse(server, req, status = '200', data = ''):
+    'The original, uncached response builder.'
+    resp = req.makeResponse()
+    resp.setStatus( status )
+    resp.setProtocol( req.getProtocol() )
+    resp.setText( resp.supportedCodes[ resp.getStatus() ] )
+    resp.setData( data )
+    if req.has_key('Cseq'):
+        resp['CSeq']            = req['CSeq']
+    resp['Cache-Control']       = 'no-cache'
+    resp['Content-length']      = len( resp.getData() )
+    resp['Date']                = asctime()
+    resp['Expires']             = resp['Date']
+    if req.has_key('Connection'):
+        resp['Connection']      = req['Connection']
+    if req.has_key('Session'):
+        resp['Session']         = req['Session']
+    resp['Server']              = server.userAgent
+    return resp
+
+def run(number = 20000, repeat = 5):
+    'Time both builders, including serialization, and return the results.'
+    server = Server()
+    req    = StreamingFactory.parse(requests['DESCRIBE'])
+    naive  = lambda: str( naiveBuildResponse(server, req) )
+    cached = lambda: str( server.buildResponse(req) )
+    results = {}
+    for name, fn in (('naive', naive), ('cached', cached)):
+        best = min( Timer(fn).repeat(repeat, number) )
+        results[name] = best / number
+    return results
+
+def main():
+    results = run()
+    for name in ('naive', 'cached'):
+        print '%-8s %8.2f usec/response' % (name, results[name] * 1e6)
+    print 'speedup  %8.2fx' % (results['naive'] / results['cached'])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+# Local stand-in RTSP target with canned responses
+# by Mario Vilas (mvilas at gmail.com)
+#
+# Run from the repository root:
+#   python -m benchmarks.target [port] [udp]
+
+import sys
+
+from rtsp_server import Server, StreamTransport, DatagramTransport
+
+from benchmarks.corpus import sdp
+
+#------------------------------------------------------------------------------
+
+class StandInServer(Server):
+    'Minimal RTSP server that answers every request with canned data'
+
+    userAgent   = 'StandInTarget'
+    sessionId   = '12345678'
+
+    def __init__(self, transportClass = StreamTransport,
+                                    bindAddress = 'localhost', bindPort = 554):
+        Server.__init__(self, transportClass, bindAddress, bindPort)
+        self.debugging = False
+
+    def do_OPTIONS(self, req, transport):
+        resp = self.buildResponse(req)
+        resp['Public'] = 'OPTIONS, DESCRIBE, SETUP, PLAY, TEARDOWN'
+        return resp
+
+    def do_DESCRIBE(self, req, transport):
+        resp = self.buildResponse(req, '200', sdp)
+        resp['Content-Base'] = req.getPath()
+        resp['Content-Type'] = 'application/sdp'
+        return resp
+
+    def do_SETUP(self, req, transport):
+        resp = self.buildResponse(req)
+        resp['Transport'] = req.get('Transport', 'RTP/AVP;unicast')
+        resp['Session']   = self.sessionId
+        return resp
+
+    def do_PLAY(self, req, transport):
+        resp = self.buildResponse(req)
+        resp['Range']    = 'npt=0.000-'
+        resp['RTP-Info'] = 'url=%s;seq=1;rtptime=0' % req.getPath()
+        return resp
+
+    def do_TEARDOWN(self, req, transport):
+        return self.buildResponse(req)
+
+#------------------------------------------------------------------------------
+
+def main():
+    port = 5540
+    transportClass = StreamTransport
+    if len(sys.argv) > 1:
+        port = int(sys.argv[1])
+    if len(sys.argv) > 2 and sys.argv[2].lower() == 'udp':
+        transportClass = DatagramTransport
+    print 'Stand-in target listening on port %d' % port
+    StandInServer(transportClass, 'localhost', port).run()
+
+if __name__ == '__main__':
+    main()
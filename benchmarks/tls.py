@@ -0,0 +1,68 @@
+# TLS handshake rate benchmark
+# by Mario Vilas (mvilas at gmail.com)
+#
+# Starts the stand-in target over TLS with a throwaway self-signed
+# certificate (made with the openssl command line tool) and measures how
+# many upstream connections per second TLSStreamTransport can open. Every
+# one is a full handshake, Python 2.7 has no API for session resumption.
+#
+# Run from the repository root:
+#   python -m benchmarks.tls
+
+import os
+import shutil
+import tempfile
+import subprocess
+
+from time import time
+
+from rtsp_server import TLSStreamTransport
+
+from benchmarks.loadgen import freePort, waitForPort
+from benchmarks.target import StandInServer
+
+#------------------------------------------------------------------------------
+
+def makeCertificate(directory):
+    'Create a self-signed certificate, return the certificate and key paths.'
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile  = os.path.join(directory, 'key.pem')
+    subprocess.check_call([
+        'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+        '-days', '1', '-subj', '/CN=localhost',
+        '-keyout', keyfile, '-out', certfile,
+    ], stdout = open(os.devnull, 'w'), stderr = subprocess.STDOUT)
+    return certfile, keyfile
+
+def handshakeRate(port, count):
+    'Open and close "count" connections, return the handshakes per second.'
+    start = time()
+    for i in xrange(count):
+        transport = TLSStreamTransport()
+        transport.connect( ('127.0.0.1', port) )
+        transport.close()
+    elapsed = time() - start
+    return count / elapsed
+
+def run(count = 200):
+    directory = tempfile.mkdtemp()
+    try:
+        certfile, keyfile = makeCertificate(directory)
+        TLSStreamTransport.configure(certfile, keyfile)
+        port   = freePort('tcp')
+        server = StandInServer(TLSStreamTransport, '127.0.0.1', port)
+        server.spawn()
+        try:
+            waitForPort('tcp', port)
+            return {'full_per_second': handshakeRate(port, count)}
+        finally:
+            server.kill(1)
+    finally:
+        shutil.rmtree(directory)
+
+def main():
+    results = run()
+    print 'full handshakes     %8.1f/s' % results['full_per_second']
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+# RTSP over HTTP tunnel throughput benchmark
+# by Mario Vilas (mvilas at gmail.com)
+#
+# Starts the stand-in target and runs the same request loop against it over
+# plain TCP and over a QuickTime style GET/POST tunnel, so the cost of the
+# base64 decoding and the extra connection shows up as the difference
+# between the two. DESCRIBE is used because its SDP body makes the
+# responses big enough for the bytes per second to mean something.
+#
+# Run from the repository root:
+#   python -m benchmarks.tunnel
+
+from base64 import b64encode
+from socket import create_connection
+from time import time
+
+from rtsp_server import Client, StreamTransport
+
+from benchmarks.loadgen import freePort, waitForPort
+from benchmarks.target import StandInServer
+
+#------------------------------------------------------------------------------
+
+tunnelGet = (
+    'GET / HTTP/1.0\r\n'
+    'x-sessioncookie: %s\r\n'
+    'Accept: application/x-rtsp-tunnelled\r\n'
+    '\r\n'
+)
+
+tunnelPost = (
+    'POST / HTTP/1.0\r\n'
+    'x-sessioncookie: %s\r\n'
+    'Content-Type: application/x-rtsp-tunnelled\r\n'
+    'Content-Length: 32767\r\n'
+    '\r\n'
+)
+
+def openPlain(port):
+    'Return a function that sends raw data and the transport to read from.'
+    transport = StreamTransport()
+    transport.connect( ('127.0.0.1', port) )
+    def send(data):
+        transport.sock.sendall(data)
+    return send, transport, [transport.sock]
+
+def openTunnel(port, cookie):
+    'Same as openPlain, but over a GET/POST tunnel pair.'
+    getSock = create_connection( ('127.0.0.1', port) )
+    getSock.sendall(tunnelGet % cookie)
+    transport = StreamTransport(getSock)
+    resp = transport.read()                 # the HTTP 200 opening the tunnel
+    if resp.getStatus() != '200':
+        raise Exception, 'Tunnel refused: %s' % resp.getLine()
+    postSock = create_connection( ('127.0.0.1', port) )
+    postSock.sendall(tunnelPost % cookie)
+    def send(data):
+        postSock.sendall( b64encode(data) )
+    return send, transport, [getSock, postSock]
+
+def exchangeRate(send, transport, duration):
+    'Send DESCRIBE requests for the given seconds, return requests and bytes.'
+    client = Client(StreamTransport)
+    client.metrics = None
+    count  = 0
+    size   = 0
+    start  = time()
+    while time() - start < duration:
+        count += 1
+        req = client.buildRequest('DESCRIBE', 'rtsp://127.0.0.1/', '', count)
+        send( str(req) )
+        before = transport.bytesRead
+        transport.read()
+        size  += transport.bytesRead - before
+    elapsed = time() - start
+    return count / elapsed, size / elapsed
+
+def measure(opener, duration):
+    send, transport, socks = opener()
+    try:
+        return exchangeRate(send, transport, duration)
+    finally:
+        for sock in socks:
+            sock.close()
+
+def run(duration = 3.0):
+    port   = freePort('tcp')
+    server = StandInServer(StreamTransport, '127.0.0.1', port)
+    server.metrics = None
+    server.spawn()
+    try:
+        waitForPort('tcp', port)
+        plain  = measure(lambda: openPlain(port), duration)
+        tunnel = measure(lambda: openTunnel(port, 'benchmark'), duration)
+        return {
+            'plain_per_second'          : plain[0],
+            'plain_bytes_per_second'    : plain[1],
+            'tunnel_per_second'         : tunnel[0],
+            'tunnel_bytes_per_second'   : tunnel[1],
+        }
+    finally:
+        server.kill(1)
+
+def main():
+    results = run()
+    print 'plain TCP   %8.1f req/s %10.1f KB/s' % (
+                                    results['plain_per_second'],
+                                    results['plain_bytes_per_second'] / 1024)
+    print 'HTTP tunnel %8.1f req/s %10.1f KB/s' % (
+                                    results['tunnel_per_second'],
+                                    results['tunnel_bytes_per_second'] / 1024)
+
+if __name__ == '__main__':
+    main()
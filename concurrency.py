@@ -0,0 +1,278 @@
+# Adaptive concurrency controller for client driven campaigns
+# by Mario Vilas (mvilas at gmail.com)
+#
+# Drives a pool of Client sessions against a target and decides how many
+# requests may be in flight at once. The limit is adjusted after every
+# response by one of these algorithms:
+#
+#   AIMDLimit       Additive increase, multiplicative decrease. The limit
+#                   grows by one per round trip while responses come back
+#                   fine, and shrinks on errors or when the latency goes
+#                   over a target.
+#   GradientLimit   Compares the recent latency against the lowest one
+#                   seen. When requests start queueing in the target the
+#                   ratio drops below one and so does the limit.
+#
+# For fixed rate runs a TokenBucket paces the requests instead, with the
+# concurrency capped at the number of sessions.
+
+from math import sqrt
+from thread import start_new_thread
+from threading import Condition, Lock
+from time import sleep
+
+from metrics import Histogram, clock
+from rtsp_server import Client, StreamTransport
+from ringlog import log
+
+#------------------------------------------------------------------------------
+
+class AIMDLimit:
+    'Additive increase, multiplicative decrease concurrency limit.'
+
+    def __init__(self, initial = 4, minimum = 1, maximum = 256,
+                                        backoff = 0.9, latencyTarget = None):
+        self.limit          = float(initial)
+        self.minimum        = minimum
+        self.maximum        = maximum
+        self.backoff        = backoff
+        self.latencyTarget  = latencyTarget     # seconds, None to ignore
+
+    def update(self, latency, error, inflight):
+        if error or (self.latencyTarget is not None and
+                                            latency > self.latencyTarget):
+            self.limit = max(self.minimum, self.limit * self.backoff)
+        elif inflight * 2 >= self.limit:    # don't grow an unused limit
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+        return self.limit
+
+class GradientLimit:
+    'Concurrency limit driven by how far the latency is above its minimum.'
+
+    def __init__(self, initial = 4, minimum = 1, maximum = 256,
+                            smoothing = 0.2, tolerance = 1.5, drift = 0.0001,
+                            backoff = 0.9):
+        self.limit      = float(initial)
+        self.minimum    = minimum
+        self.maximum    = maximum
+        self.smoothing  = smoothing
+        self.tolerance  = tolerance
+        self.drift      = drift     # lets the minimum follow a slower target
+        self.shortAlpha = 0.1
+        self.backoff    = backoff
+        self.minRtt     = None
+        self.shortRtt   = None
+
+    def update(self, latency, error, inflight):
+        if error:
+            self.limit = max(self.minimum, self.limit * self.backoff)
+            return self.limit
+        if self.minRtt is None:
+            self.minRtt = self.shortRtt = latency
+        self.minRtt    = min(latency, self.minRtt * (1 + self.drift))
+        self.shortRtt += (latency - self.shortRtt) * self.shortAlpha
+        if inflight * 2 < self.limit:
+            return self.limit       # not using the limit, nothing learned
+        gradient = self.tolerance * self.minRtt / max(self.shortRtt, 1e-6)
+        gradient = max(0.5, min(1.0, gradient))
+        newLimit = self.limit * gradient + sqrt(self.limit)
+        newLimit = self.limit * (1 - self.smoothing) + newLimit * self.smoothing
+        self.limit = max(self.minimum, min(self.maximum, newLimit))
+        return self.limit
+
+class TokenBucket:
+    'Thread safe token bucket for fixed rate pacing.'
+
+    def __init__(self, rate, burst = None):
+        self.rate   = float(rate)
+        self.burst  = burst or max(1.0, self.rate / 10)
+        self.tokens = self.burst
+        self.last   = clock()
+        self.lock   = Lock()
+
+    def acquire(self):
+        'Take one token, sleeping until one is available.'
+        while True:
+            self.lock.acquire()
+            try:
+                now = clock()
+                self.tokens = min(self.burst,
+                                  self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            finally:
+                self.lock.release()
+            sleep(delay)
+
+#------------------------------------------------------------------------------
+
+class ConcurrencyController:
+    'Runs Client sessions against a target under an adaptive limit.'
+
+    transportClass  = StreamTransport
+    timeout         = 5.0       # socket timeout for each session
+    errorStatus     = ('502', '503', '504')
+
+    def __init__(self, address, requestSource = None, limiter = None,
+                                            rate = None, maxSessions = 64):
+        self.address        = address
+        self.requestSource  = requestSource or self.defaultRequest
+        self.maxSessions    = maxSessions
+        if rate is not None:
+            self.mode       = 'fixed'
+            self.bucket     = TokenBucket(rate)
+            self.limiter    = AIMDLimit(maxSessions, maxSessions, maxSessions)
+        else:
+            self.bucket     = None
+            self.limiter    = limiter or AIMDLimit(maximum = maxSessions)
+            self.mode       = self.limiter.__class__.__name__
+        self.condition      = Condition()
+        self.running        = False
+        self.sessions       = 0
+        self.inflight       = 0
+        self.completed      = 0
+        self.errors         = 0
+        self.latency        = Histogram()
+        self.windowStart    = clock()
+        self.windowCount    = 0
+        self.rate           = 0.0
+
+    def defaultRequest(self, client, cseq):
+        url = 'rtsp://%s:%d/' % self.address
+        return client.buildRequest('OPTIONS', url, '', cseq)
+
+    #--------------------------------------------------------------------------
+
+    def start(self):
+        self.running = True
+        for i in xrange(self.maxSessions):
+            self.condition.acquire()
+            self.sessions += 1
+            self.condition.release()
+            start_new_thread(self.session, ())
+
+    def stop(self, timeout = None):
+        'Stop all sessions, return True if they finished within the timeout.'
+        self.condition.acquire()
+        try:
+            self.running = False
+            self.condition.notifyAll()
+            deadline = timeout is not None and clock() + timeout or None
+            while self.sessions:
+                if deadline is not None:
+                    remaining = deadline - clock()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+                else:
+                    self.condition.wait()
+            return True
+        finally:
+            self.condition.release()
+
+    def run(self, duration):
+        self.start()
+        try:
+            sleep(duration)
+        finally:
+            self.stop()
+        return self.stats()
+
+    #--------------------------------------------------------------------------
+
+    def acquire(self):
+        'Wait for a free slot under the limit, False if stopping.'
+        self.condition.acquire()
+        try:
+            while self.running and \
+                        self.inflight >= max(1, int(self.limiter.limit)):
+                self.condition.wait(0.1)
+            if not self.running:
+                return False
+            self.inflight += 1
+            return True
+        finally:
+            self.condition.release()
+
+    def release(self, latency, error):
+        self.condition.acquire()
+        try:
+            inflight = self.inflight
+            self.inflight  -= 1
+            self.completed += 1
+            if error:
+                self.errors += 1
+            else:
+                self.latency.record(latency)
+            self.limiter.update(latency, error, inflight)
+            now = clock()
+            self.windowCount += 1
+            if now - self.windowStart >= 1.0:
+                self.rate        = self.windowCount / (now - self.windowStart)
+                self.windowStart = now
+                self.windowCount = 0
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def session(self):
+        'Thread entry point, runs one Client session until stopped.'
+        client = Client(self.transportClass)
+        client.debugging = False
+        client.metrics   = None
+        connected = False
+        cseq = 0
+        try:
+            while self.running:
+                if self.bucket is not None:
+                    self.bucket.acquire()
+                if not self.acquire():
+                    break
+                cseq  += 1
+                error  = True
+                start  = clock()
+                try:
+                    if not connected:
+                        client.connect(*self.address)
+                        client.connection.sock.settimeout(self.timeout)
+                        connected = True
+                    req   = self.requestSource(client, cseq)
+                    resp  = client.exchange(req)
+                    error = resp.getStatus() in self.errorStatus
+                except Exception:
+                    # A failed connect() leaves its socket behind as well.
+                    connected = False
+                    try:
+                        client.disconnect()
+                    except Exception:
+                        pass
+                self.release(clock() - start, error)
+        finally:
+            if connected:
+                try:
+                    client.disconnect()
+                except Exception:
+                    log.exception()
+            self.condition.acquire()
+            self.sessions -= 1
+            self.condition.notifyAll()
+            self.condition.release()
+
+    def stats(self):
+        self.condition.acquire()
+        try:
+            return {
+                'mode'      : self.mode,
+                'limit'     : self.limiter.limit,
+                'inflight'  : self.inflight,
+                'sessions'  : self.sessions,
+                'rate'      : self.rate,
+                'completed' : self.completed,
+                'errors'    : self.errors,
+                'latency'   : self.latency.snapshot(),
+            }
+        finally:
+            self.condition.release()
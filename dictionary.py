@@ -0,0 +1,372 @@
+# Token dictionary extracted from captured traffic
+# by Mario Vilas (mvilas at gmail.com)
+#
+# Parses captured messages with ParserFactory across a process pool and
+# counts what real clients and servers send: request methods, header names,
+# header value tokens, Transport header parameters and SDP attributes. Each
+# category is counted with a count-min sketch plus a bounded set of top-K
+# candidates, so memory does not grow with the size of the corpus, and the
+# partial tables from each worker are merged as they come in.
+#
+# The result is written as a compact binary file that Dictionary opens with
+# mmap, so a mutation engine can pick real values at startup without
+# parsing anything.
+#
+# Usage:
+#   python dictionary.py [-o rtsp.dict] [-j processes] capture_file_or_dir...
+#
+# Capture files may hold any number of messages back to back.
+
+import os
+import mmap
+import random
+import struct
+
+from array import array
+from hashlib import md5
+from multiprocessing import Pool
+from operator import add
+from optparse import OptionParser
+
+from mimebased import ParserFactory, SDPSession, Request
+
+#------------------------------------------------------------------------------
+
+categories = ('method', 'header', 'token', 'transport', 'sdp')
+
+maxTokenSize = 256          # longer tokens are not worth keeping
+
+class CountMinSketch:
+    'Approximate counters in fixed memory, never underestimating.'
+
+    def __init__(self, width = 0x4000, depth = 4):
+        self.width  = width
+        self.depth  = depth
+        self.rows   = [ array('L', [0]) * width for i in xrange(depth) ]
+        # CRCs are linear, so same length tokens that collide in one row
+        # would collide in every row whatever the seed or prefix. Each MD5
+        # digest gives four independent 32 bit indexes instead.
+        self.salts  = [ '%d:' % i for i in xrange( (depth + 3) // 4 ) ]
+
+    def indexes(self, token):
+        width  = self.width
+        values = []
+        for salt in self.salts:
+            values.extend( struct.unpack('<4I', md5(salt + token).digest()) )
+        return [ value % width for value in values[ : self.depth ] ]
+
+    def add(self, token, count = 1):
+        'Count a token, return its new estimate.'
+        estimate = None
+        for row, index in zip(self.rows, self.indexes(token)):
+            value = row[index] + count
+            row[index] = value
+            if estimate is None or value < estimate:
+                estimate = value
+        return estimate
+
+    def estimate(self, token):
+        return min([ row[index]
+                     for row, index in zip(self.rows, self.indexes(token)) ])
+
+    def merge(self, other):
+        self.rows = [ array('L', map(add, row, otherRow))
+                      for row, otherRow in zip(self.rows, other.rows) ]
+
+class FrequencyTable:
+    'Most frequent tokens of one category, in bounded memory.'
+
+    def __init__(self, capacity = 4096, width = 0x4000, depth = 4):
+        self.capacity   = capacity
+        self.sketch     = CountMinSketch(width, depth)
+        self.top        = {}        # candidate token -> estimated count
+        self.total      = 0
+
+    def add(self, token, count = 1):
+        self.total += count
+        estimate = self.sketch.add(token, count)
+        top = self.top
+        if token in top or len(top) < self.capacity * 2:
+            top[token] = estimate
+        elif estimate > self.floor:
+            top[token] = estimate
+        else:
+            return
+        if len(top) >= self.capacity * 2:
+            self.prune()
+
+    floor = 0
+
+    def prune(self):
+        'Keep only the top "capacity" candidates.'
+        ranked = sorted(self.top.iteritems(), key = lambda x: -x[1])
+        ranked = ranked[ : self.capacity ]
+        self.top = dict(ranked)
+        if ranked:
+            self.floor = ranked[-1][1]
+
+    def merge(self, other):
+        self.sketch.merge(other.sketch)
+        self.total += other.total
+        estimate = self.sketch.estimate
+        candidates = set(self.top)
+        candidates.update(other.top)
+        self.top = dict([ (token, estimate(token)) for token in candidates ])
+        self.prune()
+
+    def items(self):
+        'Tokens and counts, most frequent first.'
+        ranked = sorted(self.top.iteritems(), key = lambda x: (-x[1], x[0]))
+        return ranked[ : self.capacity ]
+
+#------------------------------------------------------------------------------
+
+class Analyzer:
+    'Extracts tokens from messages into per category frequency tables.'
+
+    tokenSeparators = ';,= \t'
+
+    def __init__(self, capacity = 4096):
+        self.tables = dict([ (name, FrequencyTable(capacity))
+                                                    for name in categories ])
+        self.messages = 0
+        self.errors   = 0
+
+    def add(self, category, token):
+        if token and len(token) <= maxTokenSize:
+            self.tables[category].add(token)
+
+    def tokenize(self, value):
+        tokens = [value]
+        for separator in self.tokenSeparators:
+            split = []
+            for token in tokens:
+                split.extend( token.split(separator) )
+            tokens = split
+        return [ token.strip() for token in tokens ]
+
+    def analyzeData(self, data):
+        'Parse a buffer with any number of messages back to back.'
+        while data:
+            try:
+                if data.startswith('v='):       # bare SDP capture
+                    message = SDPSession(data)
+                else:
+                    message = ParserFactory.parse(data)
+            except Exception:
+                self.errors += 1
+                return
+            if isinstance(message, SDPSession):     # no body, takes it all
+                self.analyzeMessage(message)
+                return
+            body = message.getData()
+            try:
+                length = int( message.get('Content-Length', '0') )
+            except ValueError:
+                length = len(body)
+            data = body[length:]
+            self.analyzeMessage(message, body[:length])
+
+    def analyzeMessage(self, message, body = None):
+        self.messages += 1
+        if isinstance(message, SDPSession):
+            return self.analyzeSDP(message)
+        if isinstance(message, Request):
+            self.add('method', message.getMethod())
+        for name, value in message:
+            self.add('header', name)
+            for token in self.tokenize(value):
+                self.add('token', token)
+            if name.lower() == 'transport':
+                self.analyzeTransport(value)
+        if body is None:
+            body = message.getData()
+        contentType = message.get('Content-Type', '')
+        if body and contentType.lower().startswith('application/sdp'):
+            self.analyzeSDP( SDPSession(body) )
+
+    def analyzeTransport(self, value):
+        for spec in value.split(','):
+            for parameter in spec.split(';'):
+                parameter = parameter.strip()
+                self.add('transport', parameter)
+                if '=' in parameter:
+                    self.add('transport', parameter.split('=')[0] + '=')
+
+    def analyzeSDP(self, session):
+        for name, value in session:
+            if name == 'a':
+                self.add('sdp', 'a=' + value)
+                self.add('sdp', 'a=' + value.split(':')[0])
+            elif name in ('m', 'c', 'b', 't'):
+                self.add('sdp', '%s=%s' % (name, value))
+
+    def merge(self, other):
+        for name in categories:
+            self.tables[name].merge(other.tables[name])
+        self.messages += other.messages
+        self.errors   += other.errors
+
+def analyzeFiles(filenames):
+    'Pool worker, returns an Analyzer for a batch of capture files.'
+    analyzer = Analyzer()
+    for filename in filenames:
+        fd = open(filename, 'rb')
+        try:
+            analyzer.analyzeData( fd.read() )
+        finally:
+            fd.close()
+    return analyzer
+
+def findFiles(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                for name in sorted(files):
+                    yield os.path.join(root, name)
+        else:
+            yield path
+
+def batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def analyze(paths, processes = None, batchSize = 256):
+    'Analyze every capture file under the given paths, return an Analyzer.'
+    result = Analyzer()
+    pool = Pool(processes)
+    try:
+        work = batches(findFiles(paths), batchSize)
+        for partial in pool.imap_unordered(analyzeFiles, work):
+            result.merge(partial)
+    finally:
+        pool.close()
+        pool.join()
+    return result
+
+#------------------------------------------------------------------------------
+
+# File layout, all integers little endian:
+#   magic               8 bytes
+#   category count      uint32
+#   per category:       name (16 bytes, NUL padded), offset, entry count
+#   per category block: (offset, length, count) per entry, then the tokens
+# Entries are sorted by count, most frequent first.
+
+magic           = 'RTSPDIC1'
+headerFormat    = '<8sI'
+indexFormat     = '<16sII'
+entryFormat     = '<III'
+
+def write(analyzer, filename):
+    'Save the frequency tables as a dictionary file.'
+    blocks = []
+    for name in categories:
+        items   = analyzer.tables[name].items()
+        entries = []
+        blob    = []
+        offset  = struct.calcsize(entryFormat) * len(items)
+        for token, count in items:
+            entries.append( struct.pack(entryFormat, offset, len(token), count) )
+            blob.append(token)
+            offset += len(token)
+        blocks.append( (name, len(items), ''.join(entries) + ''.join(blob)) )
+    position = struct.calcsize(headerFormat) + \
+                            struct.calcsize(indexFormat) * len(blocks)
+    index = []
+    for name, count, data in blocks:
+        index.append( struct.pack(indexFormat, name, position, count) )
+        position += len(data)
+    fd = open(filename, 'wb')
+    try:
+        fd.write( struct.pack(headerFormat, magic, len(blocks)) )
+        fd.write( ''.join(index) )
+        for name, count, data in blocks:
+            fd.write(data)
+    finally:
+        fd.close()
+
+class Dictionary:
+    'Read only view of a dictionary file, memory mapped.'
+
+    def __init__(self, filename):
+        fd = open(filename, 'rb')
+        try:
+            self.map = mmap.mmap(fd.fileno(), 0, access = mmap.ACCESS_READ)
+        finally:
+            fd.close()
+        fileMagic, count = struct.unpack_from(headerFormat, self.map, 0)
+        if fileMagic != magic:
+            raise Exception, 'Not a dictionary file: %s' % filename
+        self.categories = {}
+        position = struct.calcsize(headerFormat)
+        indexSize = struct.calcsize(indexFormat)
+        for i in xrange(count):
+            name, offset, entries = struct.unpack_from(indexFormat, self.map,
+                                                                    position)
+            self.categories[ name.rstrip('\0') ] = (offset, entries)
+            position += indexSize
+
+    def close(self):
+        self.map.close()
+
+    def count(self, category):
+        return self.categories.get(category, (0, 0))[1]
+
+    def entry(self, category, index):
+        'Token and count of the n-th most frequent entry in a category.'
+        base, entries = self.categories[category]
+        if not 0 <= index < entries:
+            raise IndexError, index
+        offset, length, count = struct.unpack_from(entryFormat, self.map,
+                                base + index * struct.calcsize(entryFormat))
+        return self.map[ base + offset : base + offset + length ], count
+
+    def get(self, category, index):
+        return self.entry(category, index)[0]
+
+    def __iter__(self):
+        return iter(self.categories)
+
+    def tokens(self, category):
+        for index in xrange( self.count(category) ):
+            yield self.entry(category, index)
+
+    def choice(self, category, rnd = random):
+        'Random token from a category, favoring the most frequent ones.'
+        entries = self.count(category)
+        if not entries:
+            return None
+        # Squaring a uniform variable skews the pick toward low indexes.
+        index = int( entries * rnd.random() ** 2 )
+        return self.get(category, index)
+
+#------------------------------------------------------------------------------
+
+def main():
+    parser = OptionParser(usage = '%prog [options] capture_file_or_dir...')
+    parser.add_option('-o', '--output', default = 'rtsp.dict',
+                      help = 'dictionary file to write')
+    parser.add_option('-j', '--processes', type = 'int', default = None,
+                      help = 'worker processes (default: one per CPU)')
+    options, args = parser.parse_args()
+    if not args:
+        parser.error('no capture files given')
+    analyzer = analyze(args, options.processes)
+    write(analyzer, options.output)
+    print 'Parsed %d messages (%d errors)' % (analyzer.messages,
+                                                            analyzer.errors)
+    for name in categories:
+        table = analyzer.tables[name]
+        print '%-10s %8d tokens, %d distinct kept' % (name, table.total,
+                                                            len(table.items()))
+    print 'Dictionary saved to %s' % options.output
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+# Coverage feedback from instrumented targets
+# by Mario Vilas (mvilas at gmail.com)
+#
+# The target under test is compiled with AFL style edge instrumentation: it
+# attaches to the shared memory segment given in the __AFL_SHM_ID variable
+# of its environment and increments one byte per edge it executes. After
+# each proxied request we read that bitmap, bucket the hit counts the way
+# AFL does (1, 2, 3, 4-7, 8-15, 16-31, 32-127, 128+) and check it against
+# the global map of everything seen so far. Inputs that reach new buckets
+# go into the corpus queue.
+#
+# The comparison uses NumPy when it's installed. Without it the bucketing
+# is a single str.translate() call and the bitmaps are compared as big
+# integers, so it still runs in C rather than looping over each byte.
+
+import os
+import mmap
+import ctypes
+
+from binascii import hexlify, unhexlify
+from collections import deque
+from ctypes.util import find_library
+from threading import Lock
+from time import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#------------------------------------------------------------------------------
+
+mapSize     = 1 << 16               # AFL's default MAP_SIZE
+shmEnvVar   = '__AFL_SHM_ID'
+
+IPC_PRIVATE = 0
+IPC_CREAT   = 01000
+IPC_EXCL    = 02000
+IPC_RMID    = 0
+
+def makeBucketTable():
+    'Translation table from raw hit counts to AFL bucket bits.'
+    table = []
+    for count in xrange(256):
+        if   count == 0:    bucket = 0
+        elif count == 1:    bucket = 1
+        elif count == 2:    bucket = 2
+        elif count == 3:    bucket = 4
+        elif count <= 7:    bucket = 8
+        elif count <= 15:   bucket = 16
+        elif count <= 31:   bucket = 32
+        elif count <= 127:  bucket = 64
+        else:               bucket = 128
+        table.append( chr(bucket) )
+    return ''.join(table)
+
+bucketTable = makeBucketTable()
+
+if numpy is not None:
+    bucketArray = numpy.frombuffer(bucketTable, numpy.uint8).copy()
+
+#------------------------------------------------------------------------------
+
+class SharedBitmap:
+    'Coverage bitmap in SysV shared memory, the way AFL targets expect it.'
+
+    def __init__(self, size = mapSize):
+        self.size   = size
+        self.libc   = ctypes.CDLL(find_library('c'), use_errno = True)
+        self.libc.shmat.restype  = ctypes.c_void_p
+        self.libc.shmat.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int]
+        self.shmid  = self.libc.shmget(IPC_PRIVATE, size,
+                                                IPC_CREAT | IPC_EXCL | 0600)
+        if self.shmid < 0:
+            raise OSError(ctypes.get_errno(), 'shmget() failed')
+        address = self.libc.shmat(self.shmid, None, 0)
+        if address in (None, ctypes.c_void_p(-1).value):
+            self.libc.shmctl(self.shmid, IPC_RMID, None)
+            raise OSError(ctypes.get_errno(), 'shmat() failed')
+        self.address = address
+        self.reset()
+
+    def environ(self):
+        'Environment variables to pass on to the instrumented target.'
+        return { shmEnvVar : str(self.shmid) }
+
+    def read(self):
+        return ctypes.string_at(self.address, self.size)
+
+    def reset(self):
+        ctypes.memset(self.address, 0, self.size)
+
+    def close(self):
+        if self.address is not None:
+            self.libc.shmdt( ctypes.c_void_p(self.address) )
+            self.libc.shmctl(self.shmid, IPC_RMID, None)
+            self.address = None
+
+class FileBitmap:
+    'Coverage bitmap in a memory mapped file, for targets that use one.'
+
+    def __init__(self, filename, size = mapSize):
+        self.size     = size
+        self.filename = filename
+        self.zeros    = '\0' * size
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+    def environ(self):
+        return { shmEnvVar : self.filename }
+
+    def read(self):
+        return self.map[:]
+
+    def reset(self):
+        self.map[:] = self.zeros
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+#------------------------------------------------------------------------------
+
+class CoverageMap:
+    'Global coverage seen so far, updated from a shared bitmap.'
+
+    def __init__(self, bitmap, useNumPy = True):
+        self.bitmap     = bitmap
+        self.size       = bitmap.size
+        self.useNumPy   = useNumPy and numpy is not None
+        if self.useNumPy:
+            self.seen   = numpy.zeros(self.size, numpy.uint8)
+        else:
+            self.seen   = 0L
+        self.lock       = Lock()
+        self.checks     = 0
+        self.newCount   = 0
+
+    def check(self):
+        'Collect the bitmap, reset it, return how many edges hit new buckets.'
+        raw = self.bitmap.read()
+        self.bitmap.reset()
+        self.checks += 1
+        if raw.count('\0') == self.size:
+            return 0                                # nothing ran at all
+        if self.useNumPy:
+            newEdges = self.mergeArray(raw)
+        else:
+            newEdges = self.mergeLong(raw)
+        if newEdges:
+            self.newCount += 1
+        return newEdges
+
+    def mergeArray(self, raw):
+        current = bucketArray[ numpy.frombuffer(raw, numpy.uint8) ]
+        self.lock.acquire()
+        try:
+            new = current & ~self.seen
+            if not new.any():
+                return 0
+            self.seen |= current
+        finally:
+            self.lock.release()
+        return int( numpy.count_nonzero(new) )
+
+    def mergeLong(self, raw):
+        current = long( hexlify( raw.translate(bucketTable) ), 16 )
+        self.lock.acquire()
+        try:
+            new = current & ~self.seen
+            if not new:
+                return 0
+            self.seen |= current
+        finally:
+            self.lock.release()
+        return self.countEdges(new)
+
+    def countEdges(self, value):
+        data = unhexlify( '%0*x' % (self.size * 2, value) )
+        return len(data) - data.count('\0')
+
+    def coverage(self):
+        'Number of edges seen so far.'
+        if self.useNumPy:
+            return int( numpy.count_nonzero(self.seen) )
+        return self.countEdges(self.seen)
+
+    def stats(self):
+        return {
+            'checks'    : self.checks,
+            'new'       : self.newCount,
+            'edges'     : self.coverage(),
+        }
+
+class Corpus:
+    'Bounded queue of inputs that found new coverage.'
+
+    def __init__(self, maxEntries = 10000, directory = None):
+        self.queue      = deque(maxlen = maxEntries)
+        self.directory  = directory
+        self.count      = 0
+
+    def __len__(self):
+        return len(self.queue)
+
+    def __iter__(self):
+        return iter( list(self.queue) )
+
+    def add(self, data, newBits = 0):
+        entry = (time(), newBits, data)
+        self.queue.append(entry)
+        self.count += 1
+        if self.directory is not None:
+            filename = 'id_%06d_bits_%d' % (self.count, newBits)
+            fd = open(os.path.join(self.directory, filename), 'wb')
+            try:
+                fd.write(data)
+            finally:
+                fd.close()
+        return entry
+
+    def pop(self):
+        'Take the oldest entry out of the queue, or None if empty.'
+        try:
+            return self.queue.popleft()
+        except IndexError:
+            return None
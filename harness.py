@@ -0,0 +1,318 @@
+# Fork server harness for local targets
+# by Mario Vilas (mvilas at gmail.com)
+#
+# Restarting a crashed target from scratch costs far more than the test case
+# itself. Instead the target is initialized once and then forked, either for
+# every test case or every N test cases, and a crashed copy is replaced by a
+# fresh fork of the same initialized image.
+#
+# Two fork servers are supported:
+#
+#   AFLForkServer       Binaries built with AFL instrumentation, using the
+#                       AFL fork server protocol on file descriptors 198/199.
+#   PythonForkServer    Targets written with this framework. The listening
+#                       socket is bound once in the parent and inherited by
+#                       every child, so there is no rebind or startup wait.
+#
+# TargetHarness drives either one. Call begin() before each test case and
+# reconnect to the target when it returns True, then call end() afterwards
+# to find out if the target crashed. A test case may span several messages,
+# like a whole client session: check() looks for a crash between them and
+# resume() forks a new target if one happened. Cases can overlap, a fork due
+# for recycling is only replaced once none of them is running.
+#
+# Pass wait=True to end() when missing a crash costs more than crashGrace
+# seconds, otherwise only a failed case waits for the target's status.
+
+import os
+import errno
+import signal
+import socket
+import struct
+
+from collections import deque
+from select import select
+from threading import Lock, Event
+from time import time, sleep
+
+from ringlog import log
+import timers
+
+#------------------------------------------------------------------------------
+
+def afterFork():
+    'Reset the shared helpers in a forked child, their threads are gone.'
+    log.running   = False
+    log.wakeEvent = Event()
+    timers.wheel.running = False
+    timers.wheel.lock    = Lock()
+
+def describeStatus(status):
+    'Human readable description of a wait() status.'
+    if os.WIFSIGNALED(status):
+        signum = os.WTERMSIG(status)
+        for name in dir(signal):
+            if name.startswith('SIG') and not name.startswith('SIG_') and \
+                                        getattr(signal, name) == signum:
+                return 'killed by %s' % name
+        return 'killed by signal %d' % signum
+    if os.WIFEXITED(status):
+        return 'exited with code %d' % os.WEXITSTATUS(status)
+    return 'status 0x%x' % status
+
+#------------------------------------------------------------------------------
+
+class PythonForkServer:
+    'Forks copies of a Server instance that share one bound listener.'
+
+    def __init__(self, server):
+        self.server = server
+
+    def start(self):
+        self.server.listen(reuseAddress = True)     # restartable after stop()
+
+    def fork(self):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                try:
+                    afterFork()
+                    self.server.run()
+                except:
+                    pass
+            finally:
+                os._exit(0)
+        return pid
+
+    def poll(self, pid, timeout = 0):
+        'Return the status of a finished child, or None if still running.'
+        deadline = time() + timeout
+        while True:
+            try:
+                done, status = os.waitpid(pid, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if done:
+                return status
+            if time() >= deadline:
+                return None
+            sleep(0.001)
+
+    def kill(self, pid):
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+        return os.waitpid(pid, 0)[1]
+
+    def close(self):
+        self.server.listener.close()
+
+class AFLForkServer:
+    'Drives an AFL instrumented binary through its fork server protocol.'
+
+    controlFd       = 198
+    statusFd        = 199
+    startTimeout    = 10.0
+
+    def __init__(self, argv, env = None):
+        self.argv   = argv
+        self.env    = env
+        self.pid    = None
+
+    def start(self):
+        controlRead, controlWrite = os.pipe()
+        statusRead,  statusWrite  = os.pipe()
+        env = dict(os.environ)
+        if self.env:
+            env.update(self.env)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.dup2(controlRead, self.controlFd)
+                os.dup2(statusWrite, self.statusFd)
+                for fd in (controlRead, controlWrite, statusRead, statusWrite):
+                    os.close(fd)
+                devnull = os.open(os.devnull, os.O_RDWR)
+                os.dup2(devnull, 0)
+                os.execvpe(self.argv[0], self.argv, env)
+            finally:
+                os._exit(127)
+        os.close(controlRead)
+        os.close(statusWrite)
+        self.pid     = pid
+        self.control = controlWrite
+        self.status  = statusRead
+        if self.readInt(self.startTimeout) is None:
+            self.close()
+            raise Exception, \
+                    'Fork server handshake failed, is the target instrumented?'
+
+    def readInt(self, timeout = None):
+        'Read one native integer from the status pipe, None on timeout or EOF.'
+        data = ''
+        while len(data) < 4:
+            if timeout is not None:
+                if not select([self.status], [], [], timeout)[0]:
+                    return None
+            chunk = os.read(self.status, 4 - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return struct.unpack('i', data)[0]
+
+    def fork(self):
+        os.write(self.control, '\0\0\0\0')
+        pid = self.readInt(self.startTimeout)
+        if pid is None or pid <= 0:
+            raise Exception, 'Fork server failed to fork the target'
+        return pid
+
+    def poll(self, pid, timeout = 0):
+        return self.readInt(timeout)
+
+    def kill(self, pid):
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+        return self.readInt(self.startTimeout)
+
+    def close(self):
+        if self.pid is not None:
+            try:
+                os.kill(self.pid, signal.SIGKILL)
+                os.waitpid(self.pid, 0)
+            except OSError:
+                pass
+            os.close(self.control)
+            os.close(self.status)
+            self.pid = None
+
+#------------------------------------------------------------------------------
+
+class TargetHarness:
+    'Keeps a forked target running, recycling it every N cases and on crashes.'
+
+    recycleEvery    = 1         # fork a fresh target every N cases, 0 never
+    crashGrace      = 0.1       # seconds to wait for a dying target's status
+    readyTimeout    = 5.0       # seconds to wait for the target to listen
+
+    def __init__(self, forkServer, address = None, recycleEvery = None):
+        self.forkServer = forkServer
+        self.address    = address       # probed after forking, None to skip
+        if recycleEvery is not None:
+            self.recycleEvery = recycleEvery
+        self.pid        = None
+        self.cases      = 0             # test cases run on the current fork
+        self.active     = 0             # test cases begun and not yet ended
+        self.forks      = 0
+        self.crashes    = deque(maxlen = 100)
+        self.crashCount = 0
+        self.lock       = Lock()
+
+    def start(self):
+        self.forkServer.start()
+
+    def stop(self):
+        self.lock.acquire()
+        try:
+            if self.pid is not None:
+                self.forkServer.kill(self.pid)
+                self.pid = None
+            self.forkServer.close()
+        finally:
+            self.lock.release()
+
+    def respawn(self):
+        if self.pid is not None:
+            self.forkServer.kill(self.pid)  # recycled, not a crash
+        self.pid    = self.forkServer.fork()
+        self.cases  = 0
+        self.forks += 1
+        if self.address is not None:
+            self.waitForTarget()
+
+    def waitForTarget(self):
+        deadline = time() + self.readyTimeout
+        while True:
+            try:
+                socket.create_connection(self.address).close()
+                return
+            except socket.error:
+                if time() >= deadline:
+                    raise
+                sleep(0.005)
+
+    def begin(self):
+        'Call before each test case, True means reconnect to a fresh target.'
+        self.lock.acquire()
+        try:
+            # A fork due for recycling is kept while other cases still use it.
+            if self.pid is None or (self.recycleEvery and not self.active and
+                                        self.cases >= self.recycleEvery):
+                self.respawn()
+                fresh = True
+            else:
+                fresh = False
+            self.cases  += 1
+            self.active += 1
+            return fresh
+        finally:
+            self.lock.release()
+
+    def resume(self):
+        'Fork again if the target died within a case, return the fork number.'
+        self.lock.acquire()
+        try:
+            if self.pid is None:
+                self.respawn()
+            return self.forks
+        finally:
+            self.lock.release()
+
+    def end(self, testcase = None, failed = False, wait = False):
+        'Call after each test case, returns the crash status or None.'
+        self.lock.acquire()
+        try:
+            self.active = max(0, self.active - 1)
+            return self.checkStatus(testcase, failed, wait)
+        finally:
+            self.lock.release()
+
+    def check(self, testcase = None, failed = False, wait = False):
+        'Same as end() but the test case goes on, for checks between messages.'
+        self.lock.acquire()
+        try:
+            return self.checkStatus(testcase, failed, wait)
+        finally:
+            self.lock.release()
+
+    def checkStatus(self, testcase, failed, wait):
+        if self.pid is None:
+            return None
+        timeout = 0
+        if failed or wait:          # a target may answer and then die
+            timeout = self.crashGrace
+        status = self.forkServer.poll(self.pid, timeout)
+        if status is None:
+            return None
+        self.pid = None
+        self.crashes.append( (time(), status, testcase) )
+        self.crashCount += 1
+        log.warning('TARGET %s', describeStatus(status))
+        self.onCrash(testcase, status)
+        return status
+
+    def onCrash(self, testcase, status):
+        'Hook for subclasses, called when the target dies during a test case.'
+        pass
+
+    def stats(self):
+        return {
+            'forks'     : self.forks,
+            'crashes'   : self.crashCount,
+            'cases'     : self.cases,
+        }
@@ -0,0 +1,174 @@
+# Hot reloadable fuzzing hooks
+# by Mario Vilas (mvilas at gmail.com)
+#
+# A hook module defines functions named pre_<METHOD>(proxy, req, transport)
+# and post_<METHOD>(proxy, resp, transport), and optionally preUnknown and
+# postUnknown for every other method. They work like the Proxy methods of
+# the same names, anything the module doesn't define falls back to those.
+#
+# Loading a module builds an immutable HookTable and the proxy swaps it in
+# with a single attribute assignment. Serve threads read the table once per
+# message, so new hooks apply from the next request on, and sessions and
+# their upstream connections are never touched. A module that fails to load
+# leaves the current table in place.
+#
+# Every load compiles the file into a fresh module object, so requests
+# already running old hooks finish with them. To carry state across reloads
+# define onLoad(proxy, previous), it gets the previous module or None.
+
+import os
+
+from functools import partial
+from imp import new_module
+from thread import start_new_thread
+from threading import Lock
+
+import timers
+from ringlog import log
+
+#------------------------------------------------------------------------------
+
+class HookTable:
+    'Snapshot of the hooks defined by one version of a hook module.'
+
+    def __init__(self, module, version):
+        self.module         = module
+        self.version        = version
+        self.pre            = {}
+        self.post           = {}
+        for name, value in vars(module).items():
+            if not callable(value):
+                continue
+            if name.startswith('pre_'):
+                self.pre[ name[4:] ] = value
+            elif name.startswith('post_'):
+                self.post[ name[5:] ] = value
+        self.preUnknown     = getattr(module, 'preUnknown',  None)
+        self.postUnknown    = getattr(module, 'postUnknown', None)
+
+    def lookup(self, proxy, method):
+        'Return the pre and post hooks for a method, bound to the proxy.'
+        pre = self.pre.get(method, self.preUnknown)
+        if pre is None:
+            pre = getattr(proxy, 'pre_%s' % method, proxy.preUnknown)
+        else:
+            pre = partial(pre, proxy)
+        post = self.post.get(method, self.postUnknown)
+        if post is None:
+            post = getattr(proxy, 'post_%s' % method, proxy.postUnknown)
+        else:
+            post = partial(post, proxy)
+        return pre, post
+
+class HookLoader:
+    'Loads a hook module into a proxy, again whenever the file changes.'
+
+    pollInterval = 1.0      # seconds between checks of the file
+
+    def __init__(self, filename, proxy):
+        self.filename   = os.path.abspath(filename)
+        self.proxy      = proxy
+        self.lock       = Lock()
+        self.stamp      = None
+        self.version    = 0
+        self.failures   = 0
+        self.lastError  = None
+        self.timer      = None
+        self.watching   = False
+        self.generation = 0         # bumped to retire older poll timers
+
+    def getStamp(self):
+        st = os.stat(self.filename)
+        return (st.st_mtime, st.st_size, st.st_ino)
+
+    def compile(self):
+        'Build a new module object from the file.'
+        stamp = self.getStamp()
+        fd = open(self.filename, 'rU')
+        try:
+            source = fd.read()
+        finally:
+            fd.close()
+        code   = compile(source, self.filename, 'exec')
+        name   = os.path.splitext( os.path.basename(self.filename) )[0]
+        module = new_module('%s_v%d' % (name, self.version + 1))
+        module.__file__ = self.filename
+        exec code in module.__dict__
+        return module, stamp
+
+    def load(self):
+        'Load the module and install its hooks, return the new HookTable.'
+        self.lock.acquire()
+        try:
+            try:
+                module, stamp = self.compile()
+                previous = self.proxy.hooks
+                if previous is not None:
+                    previous = previous.module
+                onLoad = getattr(module, 'onLoad', None)
+                if onLoad is not None:
+                    onLoad(self.proxy, previous)
+            except Exception, e:
+                self.failures  += 1
+                self.lastError  = '%s: %s' % (e.__class__.__name__, e)
+                try:
+                    self.stamp = self.getStamp()    # don't retry until edited
+                except OSError:
+                    pass
+                raise
+            self.stamp      = stamp
+            self.version   += 1
+            self.lastError  = None
+            table = HookTable(module, self.version)
+            self.proxy.hooks = table        # serve threads see it from now on
+            log.info('HOOKS loaded %s version %d', self.filename, self.version)
+            return table
+        finally:
+            self.lock.release()
+
+    #--------------------------------------------------------------------------
+
+    def watch(self, interval = None):
+        'Reload the module whenever the file changes.'
+        self.stop()             # calling it again only changes the interval
+        if interval is not None:
+            self.pollInterval = interval
+        self.watching = True
+        self.timer = timers.wheel.schedule(self.pollInterval, self.poll,
+                                                            self.generation)
+
+    def stop(self):
+        self.watching    = False
+        self.generation += 1
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def poll(self, generation):
+        'Timer callback, the reload itself runs in its own thread.'
+        if not self.watching or generation != self.generation:
+            return
+        try:
+            changed = self.getStamp() != self.stamp
+        except OSError:
+            changed = False     # being replaced, check again later
+        if changed:
+            start_new_thread(self.reload, ())
+        self.timer = timers.wheel.schedule(self.pollInterval, self.poll,
+                                                                generation)
+
+    def reload(self):
+        'Load the module again, keeping the current hooks if it fails.'
+        try:
+            return self.load()
+        except Exception:
+            log.exception('HOOKS failed to load %s', self.filename)
+
+    def stats(self):
+        return {
+            'filename'  : self.filename,
+            'version'   : self.version,
+            'failures'  : self.failures,
+            'lastError' : self.lastError,
+            'watching'  : self.watching,
+        }
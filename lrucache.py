@@ -0,0 +1,90 @@
+# Bounded LRU cache with expiration
+# by Mario Vilas (mvilas at gmail.com)
+
+from collections import OrderedDict
+from threading import Lock
+
+from metrics import clock
+
+#------------------------------------------------------------------------------
+
+class LRUCache:
+    'Thread safe LRU cache bounded by entry count and total size.'
+
+    def __init__(self, maxEntries = 1024, maxBytes = None, ttl = None):
+        self.maxEntries = maxEntries
+        self.maxBytes   = maxBytes
+        self.ttl        = ttl
+        self.lock       = Lock()
+        self.clear()
+
+    def clear(self):
+        self.entries    = OrderedDict()     # key -> (value, size, expires)
+        self.size       = 0
+        self.hits       = 0
+        self.misses     = 0
+        self.evictions  = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default = None):
+        self.lock.acquire()
+        try:
+            try:
+                value, size, expires = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires < clock():
+                self.size   -= size
+                self.misses += 1
+                return default
+            self.entries[key] = (value, size, expires)  # most recently used
+            self.hits += 1
+            return value
+        finally:
+            self.lock.release()
+
+    def put(self, key, value, size = 1):
+        if self.maxBytes is not None and size > self.maxBytes:
+            return                              # would evict everything
+        expires = None
+        if self.ttl is not None:
+            expires = clock() + self.ttl
+        self.lock.acquire()
+        try:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[key] = (value, size, expires)
+            self.size += size
+            entries = self.entries
+            while entries and (
+                    (self.maxEntries is not None and
+                                        len(entries) > self.maxEntries) or
+                    (self.maxBytes is not None and self.size > self.maxBytes)):
+                oldKey, (oldValue, oldSize, oldExpires) = \
+                                                    entries.popitem(last = False)
+                self.size      -= oldSize
+                self.evictions += 1
+        finally:
+            self.lock.release()
+
+    def invalidate(self, key):
+        self.lock.acquire()
+        try:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        return {
+            'entries'   : len(self.entries),
+            'bytes'     : self.size,
+            'hits'      : self.hits,
+            'misses'    : self.misses,
+            'evictions' : self.evictions,
+        }
@@ -0,0 +1,185 @@
+# Latency histograms and counters for the serve loops
+# by Mario Vilas (mvilas at gmail.com)
+#
+# Histograms use HDR-style log-linear buckets: values are recorded in
+# microseconds, every power of two is split in a fixed number of linear
+# sub-buckets, so the relative error is bounded and recording a value is
+# just a few integer operations. No locks are taken on the hot path; under
+# heavy contention an increment may occasionally be lost, which is fine for
+# statistics.
+#
+# Fuzzed methods and status codes are arbitrary strings, so anything the
+# parsers don't know about is counted under OTHER, otherwise every mutation
+# would add a new histogram or counter.
+
+try:
+    from time import monotonic as clock
+except ImportError:
+    from time import time as clock      # Python 2 has no monotonic clock
+
+from time import time
+
+from mimebased import HTTPRequest, RTSPRequest, HTTPResponse, RTSPResponse
+
+#------------------------------------------------------------------------------
+
+class Histogram:
+    'Log-linear latency histogram, values in microseconds.'
+
+    subBucketBits   = 5                 # about 3% worst case relative error
+
+    def __init__(self):
+        self.halfCount  = 1 << (self.subBucketBits - 1)
+        self.counts     = [0] * (self.halfCount * 2)
+        self.total      = 0
+        self.sum        = 0
+        self.min        = None
+        self.max        = 0
+
+    def index(self, value):
+        exponent = value.bit_length() - self.subBucketBits
+        if exponent <= 0:
+            return value
+        return exponent * self.halfCount + (value >> exponent)
+
+    def lowerBound(self, index):
+        if index < self.halfCount * 2:
+            return index
+        exponent = index // self.halfCount - 1
+        return (index - exponent * self.halfCount) << exponent
+
+    def record(self, seconds):
+        value = int(seconds * 1000000)
+        if value < 0:
+            value = 0
+        index  = self.index(value)
+        counts = self.counts
+        if index >= len(counts):
+            counts.extend( [0] * (index + 1 - len(counts)) )
+        counts[index] += 1
+        self.total    += 1
+        self.sum      += value
+        if value > self.max:
+            self.max = value
+        if self.min is None or value < self.min:
+            self.min = value
+
+    def merge(self, other):
+        'Add the values recorded by another histogram to this one.'
+        counts = self.counts
+        if len(other.counts) > len(counts):
+            counts.extend( [0] * (len(other.counts) - len(counts)) )
+        for index, count in enumerate(other.counts):
+            counts[index] += count
+        self.total += other.total
+        self.sum   += other.sum
+        self.max    = max(self.max, other.max)
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+
+    def percentile(self, percent):
+        'Approximate value in microseconds at the given percentile.'
+        if not self.total:
+            return 0
+        target = self.total * percent / 100.0
+        seen   = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return min(self.lowerBound(index + 1) - 1, self.max)
+        return self.max
+
+    def snapshot(self):
+        if self.total:
+            mean = float(self.sum) / self.total
+        else:
+            mean = 0.0
+        return {
+            'count' : self.total,
+            'min'   : self.min or 0,
+            'max'   : self.max,
+            'mean'  : mean,
+            'p50'   : self.percentile(50),
+            'p90'   : self.percentile(90),
+            'p99'   : self.percentile(99),
+            'p999'  : self.percentile(99.9),
+        }
+
+#------------------------------------------------------------------------------
+
+class Metrics:
+    'Per-method, per-stage latency histograms plus global counters.'
+
+    knownMethods    = frozenset( HTTPRequest.supportedMethods +
+                                 RTSPRequest.supportedMethods )
+    knownStatus     = frozenset( HTTPResponse.supportedCodes.keys() +
+                                 RTSPResponse.supportedCodes.keys() )
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.startTime  = time()
+        self.histograms = {}
+        self.counters   = {}
+
+    def record(self, method, stage, seconds):
+        if method not in self.knownMethods:
+            method = 'OTHER'
+        key = (method, stage)
+        try:
+            histogram = self.histograms[key]
+        except KeyError:
+            histogram = self.histograms.setdefault(key, Histogram())
+        histogram.record(seconds)
+
+    def recordStages(self, method, stages, times):
+        'Record consecutive stages given their boundary timestamps.'
+        for index in xrange(len(stages)):
+            self.record(method, stages[index], times[index+1] - times[index])
+
+    def increment(self, name, amount = 1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def countResponse(self, resp):
+        'Count a response by status, keeping track of 5xx codes.'
+        if not resp.isResponse():       # server to client request
+            method = resp.getMethod()
+            if method not in self.knownMethods:
+                method = 'OTHER'
+            self.increment('request.%s' % method)
+            return
+        status = resp.getStatus()
+        if status.startswith('5'):
+            self.increment('status.5xx')
+        if status not in self.knownStatus:
+            status = 'OTHER'
+        self.increment('status.%s' % status)
+
+    def snapshot(self):
+        'Return a copy of all the metrics as plain dictionaries.'
+        stages = {}
+        for (method, stage), histogram in self.histograms.items():
+            stages.setdefault(method, {})[stage] = histogram.snapshot()
+        return {
+            'uptime'    : time() - self.startTime,
+            'counters'  : dict(self.counters),
+            'stages'    : stages,
+        }
+
+    def render(self):
+        'Return the metrics as plain text, one value per line.'
+        snapshot = self.snapshot()
+        lines = [ 'uptime %.3f' % snapshot['uptime'] ]
+        counters = snapshot['counters']
+        for name in sorted(counters.keys()):
+            lines.append( '%s %d' % (name, counters[name]) )
+        stages = snapshot['stages']
+        for method in sorted(stages.keys()):
+            for stage in sorted(stages[method].keys()):
+                values = stages[method][stage]
+                for name in sorted(values.keys()):
+                    line = 'latency_us.%s.%s.%s %s'
+                    line = line % (method, stage, name, values[name])
+                    lines.append(line)
+        return '\n'.join(lines) + '\n'
@@ -2,10 +2,94 @@
 # by Mario Vilas (mvilas at gmail.com)
 
 from urlparse import urlparse, urlsplit, urlunparse, urlunsplit
+from array import array
 
 #------------------------------------------------------------------------------
 
-class Headers:
+class URL:
+    'Parsed URL. Treat as immutable, instances are shared through parseURL.'
+
+    def __init__(self, url):
+        self.url    = url
+        self.pieces = urlsplit(url)
+        self.scheme, self.netloc, self.path, self.query, self.fragment = \
+                                                                    self.pieces
+        self.__absolute = None
+        self.__relative = None
+
+    def __str__(self):
+        return self.url
+
+    def geturl(self):
+        'Normalized URL string.'
+        if self.__absolute is None:
+            self.__absolute = urlunsplit(self.pieces)
+        return self.__absolute
+
+    def getRelative(self):
+        'URL string without the scheme and network location.'
+        if self.__relative is None:
+            self.__relative = urlunsplit( ('', '') + self.pieces[2:] )
+        return self.__relative
+
+    def getBase(self):
+        'URL string with only the scheme and network location.'
+        return urlunsplit( self.pieces[:2] + ('', '', '') )
+
+    def getAddress(self, defaultPort):
+        'Host and port number of the network location.'
+        netloc = self.netloc
+        if ':' in netloc:
+            host, port = netloc.split(':')
+        else:
+            host, port = netloc, defaultPort
+        return host, int(port)
+
+    def replace(self, scheme = None, netloc = None):
+        'Return a parsed URL with a different scheme or network location.'
+        pieces = list(self.pieces)
+        if scheme is not None:
+            pieces[0] = scheme
+        if netloc is not None:
+            pieces[1] = netloc
+        return parseURL( urlunsplit( tuple(pieces) ) )
+
+# Small memo of recently parsed URLs, the same targets are seen over and over.
+urlCache        = {}
+urlCacheSize    = 256
+
+def parseURL(url):
+    'Return a (possibly shared) URL object for the given string.'
+    try:
+        return urlCache[url]
+    except KeyError:
+        pass
+    parsed = URL(url)
+    if len(urlCache) >= urlCacheSize:
+        urlCache.clear()
+    urlCache[url] = parsed
+    return parsed
+
+#------------------------------------------------------------------------------
+
+whitespace = frozenset(' \t\n\r\x0b\x0c')
+
+def stripSpan(data, start, end):
+    'Offsets of data[start:end].strip() within data.'
+    while start < end and data[start] in whitespace:
+        start += 1
+    while end > start and data[end - 1] in whitespace:
+        end -= 1
+    return start, end
+
+class Headers(object):
+    # Parsed headers are kept as offsets into the raw header block, four per
+    # header (name start and end, value start and end). The first lookup
+    # scans the offsets, the dictionary is only built on the second one and
+    # the header list only when the headers are iterated or modified.
+    __slots__ = ('__headerDict', '__headerList', '__headerCache', '__spans',
+                 '__scanned')
+
     newline             = '\r\n'
     header_separator    = ':'
     header_fmt          = '%(name)s%(separator)s %(value)s'
@@ -25,26 +109,93 @@ class Headers:
     def __init__(self, data = None):
         if data is None:
             data = self.newline
-        self.__headerDict  = {}
-        self.__headerList  = []
-        headerCache = ''
-        beginLine = True
-        for line in data.split(self.newline):
-            headerCache += line + self.newline
+        newline     = self.newline
+        separator   = self.header_separator
+        self.__headerDict   = None
+        self.__headerList   = None
+        self.__scanned      = False
+        self.__spans        = spans = array('i')
+        beginLine   = True
+        position    = 0
+        size        = len(data)
+        while True:
+            end = data.find(newline, position)
+            if end < 0:
+                end = size
+            line = data[position:end]
             if self.is_last_header(line):
+                position = end + len(newline)
                 break
             if beginLine:
-                spline = line.split(self.header_separator)
-                name  = spline[0]
-                value = self.header_separator.join(spline[1:])
-                name  = name.strip()
-                value = value.strip()
+                colon = line.find(separator)
+                if colon < 0:
+                    spans.extend( stripSpan(data, position, end) )
+                    spans.extend( (end, end) )
+                else:
+                    colon += position
+                    spans.extend( stripSpan(data, position, colon) )
+                    spans.extend( stripSpan(data, colon + len(separator), end) )
             else:
-                name  = self.__headerList[-1][0]
-                value = line.strip()
-            self.append( (name, value) )
+                spans.extend( spans[-4:-2] )
+                spans.extend( stripSpan(data, position, end) )
             beginLine = not self.is_multi_line_header(line)
-        self.__headerCache = headerCache
+            position  = end + len(newline)
+            if end >= size:
+                break
+        if position <= size:
+            self.__headerCache = data[:position]
+        else:
+            self.__headerCache = data + newline
+
+    def __unpack(self):
+        'Build the header list and dictionary from the offsets.'
+        if self.__headerList is None:
+            spans = self.__spans
+            cache = self.__headerCache
+            self.__headerList = []
+            self.__headerDict = {}
+            for i in xrange(0, len(spans), 4):
+                self.__append( cache[ spans[i] : spans[i+1] ],
+                               cache[ spans[i+2] : spans[i+3] ] )
+            self.__spans = None
+
+    def __index(self):
+        'Build the header dictionary from the offsets.'
+        spans = self.__spans
+        cache = self.__headerCache
+        normalize = self.normalize_header
+        separator = self.value_separator
+        headerDict = {}
+        for i in xrange(0, len(spans), 4):
+            name  = normalize( cache[ spans[i] : spans[i+1] ] )
+            value = cache[ spans[i+2] : spans[i+3] ]
+            if name in headerDict:
+                headerDict[name] += separator + value
+            else:
+                headerDict[name] = value
+        self.__headerDict = headerDict
+        return headerDict
+
+    def __lookup(self, name):
+        'Scan the offsets for a header, return its value or None.'
+        if self.__scanned:
+            return self.__index().get( self.normalize_header(name) )
+        self.__scanned = True
+        spans = self.__spans
+        cache = self.__headerCache
+        normalize = self.normalize_header
+        name  = normalize(name)
+        size  = len(name)       # normalizing must not change the length
+        found = None
+        for i in xrange(0, len(spans), 4):
+            if spans[i+1] - spans[i] == size and \
+                        normalize( cache[ spans[i] : spans[i+1] ] ) == name:
+                value = cache[ spans[i+2] : spans[i+3] ]
+                if found is None:
+                    found = value
+                else:
+                    found += self.value_separator + value
+        return found
 
     def __str__(self):
         if self.__headerCache is None:
@@ -59,36 +210,76 @@ class Headers:
     def __len__(self):
         return len(str(self))
 
+    def __copy__(self):
+        cls   = self.__class__
+        clone = cls.__new__(cls)
+        getSlotCopier(cls)(self, clone)
+        if hasattr(self, '__dict__'):
+            clone.__dict__.update(self.__dict__)    # subclass without slots
+        return clone
+
+    def clear(self):
+        'Drop all references, used before returning to a MessagePool.'
+        self.__scanned      = False
+        self.__headerDict   = None
+        self.__headerList   = None
+        self.__headerCache  = None
+        self.__spans        = None
+
     def count(self):
+        if self.__headerList is None:
+            return len(self.__spans) // 4
         return len(self.__headerList)
 
     def mincount(self):
+        if self.__headerDict is None:
+            self.__index()
         return len(self.__headerDict)
 
     def get(self, name, *default):
+        if self.__headerDict is None:
+            value = self.__lookup(name)
+            if value is None and default:
+                return default[0]
+            return value
         return self.__headerDict.get(self.normalize_header(name), *default)
 
     def has_key(self, name):
+        if self.__headerDict is None:
+            return self.__lookup(name) is not None
         return self.__headerDict.has_key(self.normalize_header(name))
 
     __contains__ = has_key
 
     def __iter__(self):
+        self.__unpack()
         return self.__headerList.__iter__()
 
     def iteritems(self):
+        if self.__headerDict is None:
+            self.__index()
         return self.__headerDict.iteritems()
 
     def iterkeys(self):
+        if self.__headerDict is None:
+            self.__index()
         return self.__headerDict.iterkeys()
 
     def itervalues(self):
+        if self.__headerDict is None:
+            self.__index()
         return self.__headerDict.itervalues()
 
     def __getslice__(self, i, j):
+        self.__unpack()
         return self.__headerList[i:j]
 
     def __getitem__(self, name):
+        if self.__headerDict is None:
+            value = self.__lookup(name)
+            if value is None:
+                raise KeyError, self.normalize_header(name)
+            return value
         return self.__headerDict[self.normalize_header(name)]
 
     def __setitem__(self, name, value):
@@ -97,6 +288,7 @@ class Headers:
         self.append( (name, value) )
 
     def __delitem__(self, name):
+        self.__unpack()
         self.__headerCache = None
         name = self.normalize_header(name)
         del self.__headerDict[name]
@@ -109,6 +301,7 @@ class Headers:
                 i += 1
 
     def insert(self, index, (name, value) ):
+        self.__unpack()
         self.__headerCache = None
         self.__headerList.insert(index, (name, value))
         value = ''
@@ -120,7 +313,11 @@ class Headers:
         self.__headerDict[self.normalize_header(name)] = value
 
     def append(self, (name, value) ):
+        self.__unpack()
         self.__headerCache = None
+        self.__append(name, value)
+
+    def __append(self, name, value):
         self.__headerList.append( (name, value) )
         normal_name = self.normalize_header(name)
         if self.__headerDict.has_key(normal_name):
@@ -128,27 +325,65 @@ class Headers:
         else:
             self.__headerDict[normal_name] = value
 
+    def load(self, headerList, headerCache = None):
+        'Replace all headers at once, optionally with a pre-rendered block.'
+        self.__headerList  = headerList
+        self.__headerDict  = {}
+        self.__spans       = None
+        self.__scanned     = False
+        for name, value in headerList:
+            normal_name = self.normalize_header(name)
+            if self.__headerDict.has_key(normal_name):
+                self.__headerDict[normal_name] += self.value_separator + value
+            else:
+                self.__headerDict[normal_name] = value
+        self.__headerCache = headerCache
+
     def validate(self):
         for header in self.iterkeys():
             if header not in self.supportedHeaders:
                 return False
         return True
 
+def getSlotNames(cls):
+    'Mangled names of every slot declared by a class and its bases.'
+    names = []
+    for klass in cls.__mro__:
+        for name in klass.__dict__.get('__slots__', ()):
+            if name.startswith('__') and not name.endswith('__'):
+                name = '_%s%s' % (klass.__name__.lstrip('_'), name)
+            names.append(name)
+    return names
+
+def getSlotCopier(cls):
+    'Function that copies every slot of one instance to another, cached.'
+    if '_slotCopier' in cls.__dict__:
+        return cls._slotCopier          # not inherited, slots may differ
+    # Straight line code is several times faster than getattr/setattr in a
+    # loop, and copying prototypes is on the response building fast path.
+    source = 'def copier(self, clone):\n'
+    for name in getSlotNames(cls):
+        source += '    try: clone.%s = self.%s\n' % (name, name)
+        source += '    except AttributeError: pass\n'
+    source += '    pass\n'
+    namespace = {}
+    exec source in namespace
+    cls._slotCopier = staticmethod( namespace['copier'] )
+    return namespace['copier']
+
 #------------------------------------------------------------------------------
 
 class Message(Headers):
+    __slots__ = ('__line', '__data')
 
     def __init__(self, data = None):
-        self.supportedHeaders = tuple([self.normalize_header(x) \
-                                               for x in self.supportedHeaders])
         if data is None:
             data = self.newline * 2
         lineEnd     = data.find(self.newline)
         headerBegin = lineEnd + len(self.newline)
         self.setLine(data[:lineEnd])
         Headers.__init__(self, data[headerBegin:])
-        self.setData('')
-        dataBegin = headerBegin + len(self)
+        dataBegin = headerBegin + len(self.getHeaders())
         self.setData(data[dataBegin:])
 
     def __str__(self):
@@ -164,21 +399,40 @@ class Message(Headers):
     def setData(self, data):    self.__data  = data
     def appendData(self, data): self.__data += data
 
+    def clear(self):
+        Headers.clear(self)
+        self.__line = ''
+        self.__data = ''
+
+    @classmethod
+    def getSupportedHeaders(self):
+        'Normalized supported header names, computed once per class.'
+        try:
+            return self.__dict__['normalizedHeaders']
+        except KeyError:
+            pass
+        self.normalizedHeaders = tuple([ self.normalize_header.im_func(self, x)
+                                            for x in self.supportedHeaders ])
+        return self.normalizedHeaders
+
     @classmethod
     def identify(self, data):
         return (self.newline * 2) in data
 
     def validate(self):
         extended = self.normalize_header('X-')
+        supportedHeaders = self.getSupportedHeaders()
         for header in self.iterkeys():
             if not header.startswith(extended) and \
-                                           header not in self.supportedHeaders:
+                                           header not in supportedHeaders:
                 return False
         return True
 
 #------------------------------------------------------------------------------
 
 class Request(Message):
+    __slots__ = ('__method', '__path', '__protocol', '__parsedURL')
+
     supportedProtocols  = tuple()
     supportedMethods    = tuple()
 
@@ -194,10 +448,13 @@ class Request(Message):
 
     def setLine(self, line):
         Message.setLine(self, line)
-        spline      = line.split(' ')
-        method      = spline[0]
-        path        = spline[1]
-        protocol    = ' '.join(spline[2:])
+        if line:
+            spline      = line.split(' ')
+            method      = spline[0]
+            path        = spline[1]
+            protocol    = ' '.join(spline[2:])
+        else:
+            method, path, protocol = '', '', ''
         self.setMethod(method)
         self.setPath(path)
         self.setProtocol(protocol)
@@ -207,7 +464,15 @@ class Request(Message):
     def getProtocol(self):  return self.__protocol
 
     def setMethod(self, method):        self.__method   = method
-    def setPath(self, path):            self.__path     = path
+    def setPath(self, path):
+        self.__path      = path
+        self.__parsedURL = None
+
+    def getParsedURL(self):
+        'Request path as a URL object, cached until the path changes.'
+        if self.__parsedURL is None:
+            self.__parsedURL = parseURL( self.getPath() )
+        return self.__parsedURL
     def setProtocol(self, protocol):    self.__protocol = protocol
 
     @classmethod
@@ -226,6 +491,8 @@ class Request(Message):
 #------------------------------------------------------------------------------
 
 class Response(Message):
+    __slots__ = ('__protocol', '__status', '__text')
+
     supportedProtocols  = tuple()
     supportedCodes      = dict()
 
@@ -275,10 +542,9 @@ class Response(Message):
 #------------------------------------------------------------------------------
 
 class ReadMail(Message):
+    __slots__ = ()
 
     def __init__(self, data = None):
-        self.supportedHeaders = tuple([self.normalize_header(x) \
-                                               for x in self.supportedHeaders])
         self.setLine('')
         Headers.__init__(self, data)
         dataBegin = headerBegin + len(self)
@@ -294,6 +560,7 @@ class ReadMail(Message):
 
 
 class SendMail(Message):
+    __slots__ = ()
 
     def isRequest(self):    return True
     def isResponse(self):   return False
@@ -305,7 +572,9 @@ class SendMail(Message):
 
 #------------------------------------------------------------------------------
 
-class HTTP:
+class HTTP(object):
+    __slots__ = ()      # see HTTPRequest and HTTPResponse
+
     supportedProtocols  = ( 'HTTP/1.1', 'HTTP/1.0' )
 
     supportedHeaders    = (
@@ -358,42 +627,47 @@ class HTTP:
 
     defaultPort = 80
 
-    def getURL(self):
-        path   = self.getPath()
-        pieces = list( urlsplit(path) )
-        if pieces[0] == '':
-            pieces[0] = 'http'
-        if pieces[1] == '':
-            if not self.has_key('Host'):
+    def getParsedURL(self):
+        'Absolute URL as a URL object, cached until the path or Host change.'
+        key = ( self.getPath(), self.get('Host') )
+        try:
+            cachedKey, url = self.__absoluteURL
+            if cachedKey == key:
+                return url
+        except AttributeError:
+            pass
+        url = parseURL( key[0] )
+        scheme, netloc = None, None
+        if url.scheme == '':
+            scheme = 'http'
+        if url.netloc == '':
+            if key[1] is None:
                 raise Exception, "Can't get absolute URL"
-            pieces[1] = self['Host'].split(self.value_separator)[0].strip()
-        url = urlunsplit( tuple(pieces) )
+            netloc = key[1].split(self.value_separator)[0].strip()
+        url = url.replace(scheme, netloc)
+        self.__absoluteURL = (key, url)
         return url
 
+    def getURL(self):
+        return self.getParsedURL().geturl()
+
     def setURL(self, url):
-        pieces = urlsplit(url)
-        if pieces[1] != '':
-            self['Host'] = pieces[1]
+        parsed = parseURL(url)
+        if parsed.netloc != '':
+            self['Host'] = parsed.netloc
             if not '://' in self.getPath():
-                pieces = ('', '') + pieces[2:]  # relative path
-                url    = urlunsplit(pieces)
+                url = parsed.getRelative()      # relative path
         self.setPath(url)                       # absolute path
 
     def getBaseURL(self):
-        url = self.getURL()
-        pieces = urlsplit(url)
-        pieces = pieces[:2] + ( ('',) * (len(pieces) - 2) )
-        path   = urlunsplit(pieces)
-        return path
+        return self.getParsedURL().getBase()
 
     def getRelativeURL(self):
-        url = self.getURL()
-        pieces = urlsplit(url)
-        pieces = ('', '') + pieces[2:]
-        path   = urlunsplit(pieces)
-        return path
+        return self.getParsedURL().getRelative()
 
 class HTTPRequest(HTTP, Request):
+    __slots__ = ('_HTTP__absoluteURL',)
+
     supportedMethods    = (
         'OPTIONS',
         'GET',
@@ -410,6 +684,8 @@ class HTTPRequest(HTTP, Request):
     )
 
 class HTTPResponse(HTTP, Response):
+    __slots__ = ('_HTTP__absoluteURL',)
+
     supportedCodes      = {
         '100': 'Continue',
         '101': 'Switching Protocols',
@@ -463,8 +739,10 @@ HTTP.makeResponse = HTTPResponse
 
 #------------------------------------------------------------------------------
 
-class RTSP:
-    supportedProtocols  = ( 'RTSP/1.0' )
+class RTSP(object):
+    __slots__ = ()
+
+    supportedProtocols  = ( 'RTSP/1.0', )
 
     supportedHeaders    = (
         'Accept',
@@ -522,6 +800,7 @@ class RTSP:
         self.setPath(url)
 
 class RTSPRequest(RTSP, Request):
+    __slots__ = ()
 
     supportedMethods    = (
         'OPTIONS',
@@ -538,6 +817,8 @@ class RTSPRequest(RTSP, Request):
     )
 
 class RTSPResponse(RTSP, Response):
+    __slots__ = ()
+
     supportedCodes        = HTTPResponse.supportedCodes
     supportedCodes['250'] = 'Low on Storage Space'
     supportedCodes['405'] = 'Method Not Allowed'
@@ -590,6 +871,8 @@ RTSP.makeResponse = RTSPResponse
 #         a=* (zero or more media attribute lines)
 #
 class SDPSession(Headers):
+    __slots__ = ()
+
     header_separator    = '='
     header_fmt          = '%(name)s%(separator)s%(value)s'
 
@@ -635,11 +918,13 @@ class Factory:
                 return parserClass
 
     @classmethod
-    def parse(self, data):
+    def parse(self, data, pool = None):
         'Try to parse the data and return a single Message object.'
         parserClass = self.getParser(data)
         if parserClass is None:
             raise Exception, 'No suitable parser was found'
+        if pool is not None:
+            return pool.acquire(parserClass, data)
         return parserClass(data)
 
     @classmethod
@@ -660,6 +945,42 @@ class Factory:
                 data = message.getData()
         return messageList
 
+class MessagePool:
+    'Freelists of message objects to reuse instead of allocating new ones.'
+
+    def __init__(self, maxSize = 256):
+        self.maxSize    = maxSize       # per message class
+        self.freelists  = {}
+        self.allocated  = 0
+        self.reused     = 0
+
+    def acquire(self, messageClass, data = None):
+        'Return a message of the given class initialized with the data.'
+        try:
+            message = self.freelists[messageClass].pop()
+            self.reused += 1
+        except (KeyError, IndexError):
+            message = messageClass.__new__(messageClass)
+            self.allocated += 1
+        message.__init__(data)
+        return message
+
+    def release(self, message):
+        'Give a message back, nothing else may be holding a reference to it.'
+        freelist = self.freelists.setdefault(message.__class__, [])
+        if len(freelist) < self.maxSize:
+            message.clear()
+            freelist.append(message)
+
+    def stats(self):
+        return {
+            'allocated' : self.allocated,
+            'reused'    : self.reused,
+            'free'      : sum([ len(x) for x in self.freelists.values() ]),
+        }
+
+#------------------------------------------------------------------------------
+
 class GenericFactory(Factory):
     'Example factory that can only parse generic Message objects.'
     registeredParsers = (
@@ -0,0 +1,204 @@
+# Parallel delta debugging minimizer for crashing message sequences
+# by Mario Vilas (mvilas at gmail.com)
+#
+# Takes a recorded sequence of raw messages that crashes the target and
+# reduces it with delta debugging (ddmin), first dropping whole messages,
+# then headers from each message's header list, and finally bytes from the
+# header values and bodies. Every round of candidate reductions is replayed
+# in parallel, one candidate per fork server harness (see harness.py), so
+# the pool size bounds how many target copies run at the same time.
+#
+# The harnesses should fork a fresh target for every test case
+# (recycleEvery = 1) and have their address set, the minimizer connects to
+# it to replay each candidate.
+
+import os
+
+from Queue import Queue
+from multiprocessing.pool import ThreadPool
+
+from mimebased import Message
+from rtsp_server import StreamTransport
+from ringlog import log
+
+#------------------------------------------------------------------------------
+
+def split(items, n):
+    'Split a list into n chunks of (nearly) the same size.'
+    chunks = []
+    start  = 0
+    for i in xrange(n):
+        end = start + (len(items) - start) // (n - i)
+        chunks.append( items[start:end] )
+        start = end
+    return chunks
+
+class Minimizer:
+    'Reduces a crashing message sequence against a pool of fork servers.'
+
+    transportClass  = StreamTransport
+    replayTimeout   = 2.0       # seconds to wait for each response
+    fixLength       = True      # keep Content-Length in sync with bodies
+
+    def __init__(self, harnesses):
+        self.harnesses  = Queue()
+        for harness in harnesses:
+            self.harnesses.put(harness)
+        self.pool       = ThreadPool( len(harnesses) )
+        self.results    = {}        # tested sequence -> crashed?
+        self.signal     = None
+        self.tests      = 0
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    #--------------------------------------------------------------------------
+
+    def replay(self, sequence):
+        'Send a sequence to a fresh target, return the crash status or None.'
+        harness = self.harnesses.get()
+        try:
+            harness.begin()
+            failed = False
+            transport = self.transportClass()
+            try:
+                transport.connect(harness.address)
+                if transport.sock is not None:
+                    transport.sock.settimeout(self.replayTimeout)
+                for data in sequence:
+                    transport.write(data)
+                    transport.read()
+            except Exception:
+                failed = True
+            try:
+                transport.close()
+            except Exception:
+                pass
+            # A target can answer the last message and die right after,
+            # so always give it the crash grace period before deciding.
+            return harness.end(sequence, failed, wait = True)
+        finally:
+            self.harnesses.put(harness)
+
+    def reproduces(self, status):
+        return status is not None and os.WIFSIGNALED(status) and \
+                    (self.signal is None or os.WTERMSIG(status) == self.signal)
+
+    def test(self, sequence):
+        'Replay a sequence unless it was tested already, True if it crashed.'
+        sequence = tuple(sequence)
+        result = self.results.get(sequence)
+        if result is None:
+            self.tests += 1
+            result = self.reproduces( self.replay(sequence) )
+            self.results[sequence] = result
+        return result
+
+    def first(self, candidates, render):
+        'Test the candidates in parallel, return the first one that crashed.'
+        sequences = [ tuple( render(candidate) ) for candidate in candidates ]
+        crashed   = self.pool.map(self.test, sequences)
+        for candidate, result in zip(candidates, crashed):
+            if result:
+                return candidate
+
+    def ddmin(self, items, render):
+        'Delta debugging over a list, render() turns it into a sequence.'
+        if len(items) > 0 and self.test( render([]) ):
+            return []
+        n = 2
+        while len(items) >= 2:
+            chunks = split(items, min(n, len(items)))
+            candidates = []
+            for i in xrange(len(chunks)):
+                complement = []
+                for chunk in chunks[:i] + chunks[i+1:]:
+                    complement.extend(chunk)
+                candidates.append(complement)
+            found = self.first(candidates, render)
+            if found is not None:
+                items = found
+                n = max(n - 1, 2)
+            elif n >= len(items):
+                break
+            else:
+                n = min(n * 2, len(items))
+        return items
+
+    #--------------------------------------------------------------------------
+
+    def parse(self, sequence):
+        self.messages = []
+        for data in sequence:
+            message = Message(data)
+            self.messages.append( [message.getLine(), message[:],
+                                   message.getData(), message.getData()] )
+
+    def render(self, index = None, line = None, headers = None, body = None,
+                                                            messages = None):
+        'Build the sequence, optionally replacing parts of one message.'
+        if messages is None:
+            messages = self.messages
+        sequence = []
+        for i in xrange(len(messages)):
+            msgLine, msgHeaders, msgBody, original = messages[i]
+            if i == index:
+                if line    is not None: msgLine    = line
+                if headers is not None: msgHeaders = headers
+                if body    is not None: msgBody    = body
+            sequence.append( self.build(msgLine, msgHeaders, msgBody, original) )
+        return sequence
+
+    def build(self, line, headers, body, original):
+        if self.fixLength and body != original:
+            length  = str( len(body) )
+            headers = [ (name, name.lower() == 'content-length' and
+                                length or value) for name, value in headers ]
+        message = Message()
+        message.setLine(line)
+        message.load(list(headers))
+        message.setData(body)
+        return str(message)
+
+    def minimize(self, sequence):
+        'Return the smallest crashing sequence found.'
+        self.results = {}
+        self.signal  = None
+        status = self.replay( tuple(sequence) )
+        if status is None or not os.WIFSIGNALED(status):
+            raise Exception, 'The sequence does not crash the target'
+        self.signal = os.WTERMSIG(status)
+        self.parse(sequence)
+
+        # Whole messages.
+        messages = self.messages
+        render   = lambda keep: self.render(
+                                    messages = [ messages[i] for i in keep ])
+        keep = self.ddmin( range(len(messages)), render )
+        self.messages = [ messages[i] for i in keep ]
+        log.info('MINIMIZER %d of %d messages left', len(keep), len(messages))
+
+        # Headers of each message.
+        for index in xrange(len(self.messages)):
+            render  = lambda headers: self.render(index, headers = headers)
+            headers = self.ddmin( self.messages[index][1], render )
+            self.messages[index][1] = headers
+
+        # Bytes of each header value and body.
+        for index in xrange(len(self.messages)):
+            headers = self.messages[index][1]
+            for position in xrange(len(headers)):
+                name, value = headers[position]
+                def render(chars):
+                    changed = list(headers)
+                    changed[position] = (name, ''.join(chars))
+                    return self.render(index, headers = changed)
+                value = ''.join( self.ddmin( list(value), render ) )
+                headers[position] = (name, value)
+            render = lambda chars: self.render(index, body = ''.join(chars))
+            body = self.ddmin( list(self.messages[index][2]), render )
+            self.messages[index][2] = ''.join(body)
+
+        log.info('MINIMIZER done after %d tests', self.tests)
+        return self.render()
@@ -0,0 +1,105 @@
+# Sampling profiler for the serve threads
+# by Mario Vilas (mvilas at gmail.com)
+#
+# Takes snapshots of the stacks of a set of threads at a fixed rate, for a
+# limited amount of time, and writes them as folded stacks (one line per
+# unique stack, frames separated by semicolons, followed by the number of
+# samples). The output can be fed directly to flamegraph.pl or speedscope.
+#
+# Nothing is paid while the profiler is not running, and while it's running
+# the cost is one sys._current_frames() call per sample.
+
+import sys
+
+from os.path import basename
+from thread import start_new_thread, get_ident
+from threading import Event
+from time import time, sleep
+
+#------------------------------------------------------------------------------
+
+class SamplingProfiler:
+    'Periodically samples thread stacks and aggregates them.'
+
+    frame_fmt   = '%(name)s (%(filename)s:%(lineno)d)'
+
+    def __init__(self, threads = None, rate = 100, filename = None):
+        # threads is a callable returning the thread IDs to sample,
+        # or None to sample every thread except the profiler itself.
+        self.threads    = threads
+        self.rate       = rate
+        self.filename   = filename
+        self.stacks     = {}
+        self.samples    = 0
+        self.running    = False
+        self.doneEvent  = Event()
+
+    def start(self, duration):
+        'Start sampling in a background thread for the given seconds.'
+        if self.running:
+            raise Exception, 'Profiler already running'
+        self.running = True
+        self.doneEvent.clear()
+        start_new_thread(self.run, (duration,))
+
+    def stop(self):
+        self.running = False
+
+    def wait(self, timeout = None):
+        return self.doneEvent.wait(timeout)
+
+    def run(self, duration):
+        try:
+            interval = 1.0 / self.rate
+            deadline = time() + duration
+            myself   = get_ident()
+            while self.running and time() < deadline:
+                self.sample(myself)
+                sleep(interval)
+            if self.filename:
+                self.write(self.filename)
+        finally:
+            self.running = False
+            self.doneEvent.set()
+
+    def sample(self, myself = None):
+        frames = sys._current_frames()
+        if self.threads is None:
+            targets = frames.keys()
+        else:
+            targets = self.threads()
+        for ident in targets:
+            if ident == myself:
+                continue
+            frame = frames.get(ident)
+            if frame is None:
+                continue
+            stack = self.fold(frame)
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+        self.samples += 1
+
+    def fold(self, frame):
+        'Convert a frame into a folded stack, outermost frame first.'
+        labels = []
+        while frame is not None:
+            code     = frame.f_code
+            name     = code.co_name
+            filename = basename(code.co_filename)
+            lineno   = code.co_firstlineno
+            labels.append(self.frame_fmt % vars())
+            frame = frame.f_back
+        labels.reverse()
+        return ';'.join(labels)
+
+    def folded(self):
+        'Return the folded stacks as text, most frequent first.'
+        items = sorted(self.stacks.items(), key = lambda x: -x[1])
+        lines = [ '%s %d' % (stack, count) for stack, count in items ]
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename):
+        fd = open(filename, 'w')
+        try:
+            fd.write( self.folded() )
+        finally:
+            fd.close()
@@ -0,0 +1,173 @@
+# Non-blocking debug log
+# by Mario Vilas (mvilas at gmail.com)
+#
+# Records are filtered by level and sampling rate at the call site, then
+# stored unformatted in a bounded ring buffer. A background thread drains the
+# ring and does the formatting and the console I/O, so the serve loops never
+# block on stdout. The most recent records are also kept in a history ring
+# that can be dumped when a crash is detected.
+
+import sys
+import atexit
+import traceback
+
+from collections import deque
+from thread import start_new_thread, get_ident
+from threading import Event
+from time import time, strftime, localtime
+
+#------------------------------------------------------------------------------
+
+DEBUG       = 10
+INFO        = 20
+WARNING     = 30
+ERROR       = 40
+
+levelNames  = {
+    DEBUG   : 'DEBUG',
+    INFO    : 'INFO',
+    WARNING : 'WARNING',
+    ERROR   : 'ERROR',
+}
+
+#------------------------------------------------------------------------------
+
+class Logger:
+    'Leveled, sampled logger backed by a ring buffer and a drain thread.'
+
+    record_fmt  = '%(timestamp)s.%(msecs)03d [%(levelName)s] %(thread)x: %(text)s'
+
+    def __init__(self, level = WARNING, size = 4096, stream = None,
+                                            historySize = 256, interval = 0.1):
+        self.level          = level
+        self.stream         = stream
+        self.interval       = interval
+        self.sampling       = {}
+        self.samplingCount  = {}
+        self.crashDump      = False
+        self.dropped        = 0
+        self.size           = size
+        self.queue          = deque()
+        self.history        = deque(maxlen = historySize)
+        self.historyLevel   = DEBUG
+        self.wakeEvent      = Event()
+        self.running        = False
+
+    def setLevel(self, level):
+        self.level = level
+
+    def setSampling(self, level, rate):
+        'Keep only one of every "rate" records at the given level.'
+        if rate is None or rate <= 1:
+            self.sampling.pop(level, None)
+        else:
+            self.sampling[level] = rate
+        self.samplingCount[level] = 0
+
+    def isEnabled(self, level):
+        return level >= self.level or \
+                        (self.crashDump and level >= self.historyLevel)
+
+    def log(self, level, fmt, *args):
+        if not self.isEnabled(level):
+            return
+        rate = self.sampling.get(level)
+        if rate is not None:
+            count = self.samplingCount.get(level, 0) + 1
+            self.samplingCount[level] = count
+            if count % rate:
+                return
+        record = (time(), level, get_ident(), fmt, args)
+        if self.crashDump:
+            self.history.append(record)
+        if level < self.level:
+            return
+        if len(self.queue) >= self.size:
+            self.dropped += 1
+            return
+        self.queue.append(record)
+        if not self.running:
+            self.start()
+
+    def debug(self, fmt, *args):    self.log(DEBUG,   fmt, *args)
+    def info(self, fmt, *args):     self.log(INFO,    fmt, *args)
+    def warning(self, fmt, *args):  self.log(WARNING, fmt, *args)
+    def error(self, fmt, *args):    self.log(ERROR,   fmt, *args)
+
+    def exception(self, fmt = 'Unhandled exception', *args):
+        'Log the current exception and dump the history if enabled.'
+        if not self.isEnabled(ERROR):
+            return
+        # The traceback must be captured now, it's gone once we return.
+        text = traceback.format_exc()
+        self.log(ERROR, fmt + '\n%s', *(args + (text,)))
+        if self.crashDump:
+            self.dump()
+
+    def format(self, record):
+        timestamp, level, thread, fmt, args = record
+        if args:
+            try:
+                text = fmt % args
+            except Exception:
+                text = '%s %r' % (fmt, args)
+        else:
+            text = fmt
+        msecs     = int((timestamp - int(timestamp)) * 1000)
+        timestamp = strftime('%H:%M:%S', localtime(timestamp))
+        levelName = levelNames.get(level, str(level))
+        return self.record_fmt % vars()
+
+    def write(self, lines):
+        stream = self.stream
+        if stream is None:
+            stream = sys.stdout
+        stream.write('\n'.join(lines) + '\n')
+        stream.flush()
+
+    def flush(self):
+        'Format and write every queued record.'
+        lines = []
+        try:
+            while True:
+                lines.append( self.format( self.queue.popleft() ) )
+        except IndexError:
+            pass
+        dropped, self.dropped = self.dropped, 0
+        if dropped:
+            lines.append('[%d log records dropped]' % dropped)
+        if lines:
+            self.write(lines)
+
+    def dump(self):
+        'Write the history ring, most recent record last.'
+        lines = ['-' * 30 + ' crash dump ' + '-' * 30]
+        lines.extend( [ self.format(r) for r in list(self.history) ] )
+        lines.append('-' * 72)
+        self.flush()
+        self.write(lines)
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            start_new_thread(self.run, ())
+
+    def stop(self):
+        self.running = False
+        self.wakeEvent.set()
+
+    def run(self):
+        while self.running:
+            self.wakeEvent.wait(self.interval)
+            self.wakeEvent.clear()
+            try:
+                self.flush()
+            except Exception:
+                pass
+
+#------------------------------------------------------------------------------
+
+# Shared logger used by the transports, servers and proxies.
+log = Logger()
+
+atexit.register(log.flush)
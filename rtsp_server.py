@@ -2,43 +2,78 @@
 # by Mario Vilas (mvilas at gmail.com)
 
 # TO DO list:
-#   [ ] Encapsulate RTSP into HTTP
+#   [x] Encapsulate RTSP into HTTP
 #   [ ] Handle more than one message in a single UDP packet
 #   [ ] Parse SDP announcements
 #   [ ] Implement RDP
 #   [ ] Serialize access to Transport objects
 
 import mimebased
-from mimebased import Message, StreamingFactory
+from mimebased import Message, StreamingFactory, MessagePool
 from mimebased import RTSPRequest, RTSPResponse, HTTPRequest, HTTPResponse
 
-from urlparse import urlsplit, urlunsplit
-from thread import start_new_thread
-from threading import Event
-from socket import socket, AF_INET, SOCK_DGRAM, SOCK_STREAM
+from urlparse import urlsplit
+from thread import start_new_thread, get_ident
+from threading import Event, Lock, BoundedSemaphore
+from socket import socket, AF_INET, SOCK_DGRAM, SOCK_STREAM, SHUT_RDWR
+from socket import SOL_SOCKET, SO_REUSEADDR
+from socket import error as socket_error
+from errno import EAGAIN, EWOULDBLOCK
+from collections import deque
 from select import select
-from time import asctime
+from time import asctime, localtime, time
+from copy import copy
+from binascii import a2b_base64
+import signal
+import sys
 
-import traceback
+try:
+    from socket import MSG_DONTWAIT
+except ImportError:
+    MSG_DONTWAIT = 0    # not available on Windows, select before sending
+
+try:
+    import ssl
+except ImportError:
+    ssl = None          # no RTSPS support
+
+from ringlog import log, DEBUG
+from metrics import Metrics, clock
+from profiler import SamplingProfiler
+import timers
+from lrucache import LRUCache
+from feedback import CoverageMap, Corpus
+from anomalies import AnomalyIndex
+from hooks import HookLoader
+
+# Format used to log whole messages in debug mode.
+messageDump = '-' * 79 + '\n%s\n' + '-' * 79
 
 #==============================================================================
 
 class Transport:
     'Virtual base class for Transport objects'
 
+    messagePool = None      # MessagePool to parse into, if any
+    tunnelling  = False     # return HTTP tunnel requests as soon as read
+
     def __init__(self, sock = None):
         self.sock = sock
         if self.sock is None:
             self.create()
+        self.bytesRead      = 0
+        self.bytesWritten   = 0
+        self.readStart      = None
+        self.lock           = Lock()    # held for a request/response exchange
 
     def parse(self, data):
-        return StreamingFactory.parse(data)
+        return StreamingFactory.parse(data, self.messagePool)
 
     def recursive(self, data):
         return StreamingFactory.recursive(data)
 
     def connect(self, address):
-        print 'CONNECTING TO %s:%d' % address           # XXX
+        log.debug('CONNECTING TO %s:%d', *address)
         if self.sock is None:
             self.create()
         self.address = address
@@ -53,6 +88,18 @@ class Transport:
         self.mask = mask
         return self.sock.bind(mask)
 
+    def throttle(self):
+        pass
+
+    def abort(self):
+        'Wake up any thread blocked on this transport, leaving it unusable.'
+        sock = self.sock
+        if sock is not None:
+            try:
+                sock.shutdown(SHUT_RDWR)
+            except socket_error:
+                pass
+
 #------------------------------------------------------------------------------
 
 class DatagramTransport(Transport):
@@ -69,41 +116,158 @@ class DatagramTransport(Transport):
         select( [self.sock], [], [] )
         if self.sock is None:
             return
+        # Each datagram is served by its own transport, sharing the socket.
+        data, peerAddress       = self.sock.recvfrom(0x10000)
         newTransport            = self.__class__(self.sock)
+        newTransport.address    = peerAddress
+        newTransport.pending    = data
 ##        newTransport.parserList = self.parserList
         return newTransport
 
     def read(self):
-        data    = self.sock.recv(0x10000)
+        data = getattr(self, 'pending', None)
+        if data is None:
+            data = self.sock.recv(0x10000)
+        else:
+            self.pending = None
+        self.readStart  = clock()
+        self.bytesRead += len(data)
         message = self.parse(data)
         return message
 
     def write(self, message):
         data   = str(message)
         retval = self.sock.sendto(data, self.address)
+        self.bytesWritten += len(data)
+        if hasattr(self, 'pending'):
+            self.sock = None    # datagram answered, keep the shared socket
         return retval
 
+    def close(self):
+        if hasattr(self, 'pending'):
+            self.sock = None    # never close the listener's socket
+        else:
+            Transport.close(self)
+
 #------------------------------------------------------------------------------
 
 class StreamTransport(Transport):
     'Plain TCP transport'
 
-##    def __init__(self, sock = None):
-##        Transport.__init__(self, sock)
-##        self.write_buffer = ''
-##
-##    def feed(self, data):
-##        self.write_buffer += data
-##
-##    def consume(self, timeout = 0.5):
-##        count   = 0
-##        r, w, e = select( [], [self.sock], [], timeout )
-##        if self.sock in w:
-##            data, self.write_buffer = self.write_buffer, ''
-##            count = self.sock.send(data)
-##            data  = data[:count]
-##            self.write_buffer = data + self.write_buffer
-##        return count
+    # Outgoing data is queued and sent without blocking whenever the socket
+    # is writable, so a slow peer never stalls the serve thread on a send.
+    # Above the high watermark the serve loops stop producing data for this
+    # transport (see throttle) until the queue drains below the low one.
+    highWatermark   = 0x40000
+    lowWatermark    = 0x10000
+    maxSendSize     = 0x10000
+    lingerTimeout   = 5.0
+    sendFlags       = MSG_DONTWAIT
+
+    def __init__(self, sock = None):
+        Transport.__init__(self, sock)
+        self.readBuffer     = ''
+        self.writeQueue     = deque()
+        self.writeOffset    = 0         # bytes of writeQueue[0] already sent
+        self.queuedBytes    = 0
+        self.writeLock      = Lock()
+
+    def feed(self, data):
+        self.writeLock.acquire()
+        try:
+            self.writeQueue.append(data)
+            self.queuedBytes += len(data)
+        finally:
+            self.writeLock.release()
+
+    def consume(self, timeout = 0):
+        'Send as much queued data as possible, coalescing small writes.'
+        if not self.writeQueue:
+            return 0
+        if timeout != 0 or not self.sendFlags:
+            r, w, e = select( [], [self.sock], [], timeout )
+            if not w:
+                return 0
+        self.writeLock.acquire()
+        try:
+            queue  = self.writeQueue
+            head   = queue[0]
+            offset = self.writeOffset
+            if len(queue) == 1 or len(head) - offset >= self.maxSendSize:
+                # Send straight from the first chunk, big ones aren't copied.
+                count   = self.sendSome( buffer(head, offset, self.maxSendSize) )
+                offset += count
+                if offset >= len(head):
+                    queue.popleft()
+                    offset = 0
+                self.writeOffset = offset
+            else:
+                chunks = [ head[offset:] ]
+                size   = len(chunks[0])
+                queue.popleft()
+                while queue and size + len(queue[0]) <= self.maxSendSize:
+                    chunk = queue.popleft()
+                    chunks.append(chunk)
+                    size += len(chunk)
+                data  = ''.join(chunks)
+                count = self.sendSome(data)
+                if count < len(data):
+                    queue.appendleft(data)
+                    self.writeOffset = count
+                else:
+                    self.writeOffset = 0
+            self.queuedBytes  -= count
+            self.bytesWritten += count
+        finally:
+            self.writeLock.release()
+        return count
+
+    def sendSome(self, data):
+        'Send what the socket takes right now, return the number of bytes.'
+        try:
+            return self.sock.send(data, self.sendFlags)
+        except socket_error, e:
+            if e.args[0] not in (EAGAIN, EWOULDBLOCK):
+                raise
+            return 0
+
+    def flush(self, threshold = 0, timeout = None):
+        'Block until no more than "threshold" bytes remain queued.'
+        if timeout is not None:
+            deadline = time() + timeout
+        while self.queuedBytes > threshold and self.sock is not None:
+            if timeout is None:
+                remaining = None
+            else:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    return False
+            self.consume(remaining)
+        return True
+
+    def throttle(self):
+        'Pause the caller while the peer is not keeping up with our writes.'
+        if self.queuedBytes > self.highWatermark:
+            log.debug('THROTTLING, %d BYTES QUEUED', self.queuedBytes)
+            self.flush(self.lowWatermark)
+
+    def receive(self, size):
+        'Receive data, sending queued data while waiting for it.'
+        while self.writeQueue:
+            r, w, e = select( [self.sock], [self.sock], [] )
+            if w:
+                self.consume()
+            if r:
+                break
+        return self.sock.recv(size)
+
+    def close(self):
+        if self.sock is not None and self.writeQueue:
+            try:
+                self.flush(timeout = self.lingerTimeout)
+            except Exception:
+                pass
+        Transport.close(self)
 
     def create(self):
         self.sock = socket(AF_INET, SOCK_STREAM)
@@ -123,33 +287,47 @@ class StreamTransport(Transport):
         return newTransport
 
     def read(self):
-        print 'READING'                                         # XXX
+        log.debug('READING')
 ##        if self.sock is None:
 ##            self.connect(self.address)
-        rawData = ''
+        rawData, self.readBuffer = self.readBuffer, ''
+        if rawData:
+            self.readStart = clock()
         maxHeader = 0x1000
         endHeader = Message.newline * 2
         while endHeader not in rawData:
             recvSize = maxHeader - len(rawData)
             if recvSize <= 0:
                 raise Exception, 'Bad header'
-            newData = self.sock.recv(recvSize)
+            newData = self.receive(recvSize)
+            if not rawData:
+                self.readStart = clock()
             if len(newData) == 0:
                 raise Exception, 'Connection closed by peer'
             rawData += newData
+            self.bytesRead += len(newData)
         message = self.parse(rawData)
+        if self.tunnelling and isTunnelRequest(message):
+            return message      # the body is streamed, see TunnelTransport
         contentLength = message.get('Content-length', '0')
-        contentLength = long(contentLength)
-        print 'CONTENT LENGTH %d' % contentLength               # XXX
-        if contentLength > 0:
-            recvSize = len(message.getData())
+        contentLength = max(0, long(contentLength))     # negative means none
+        log.debug('CONTENT LENGTH %d', contentLength)
+        data = message.getData()
+        if len(data) > contentLength:
+            # Keep the beginning of the next message for the next read.
+            message.setData( data[:contentLength] )
+            self.readBuffer = data[contentLength:]
+        elif contentLength > 0:
+            recvSize = len(data)
             missingSize = contentLength - recvSize
-            print 'MISSING DATA %d' % missingSize               # XXX
+            log.debug('MISSING DATA %d', missingSize)
             while missingSize > 0:
-                newData = self.sock.recv(0x1000)
-                message.appendData(newData)
+                newData = self.receive( min(missingSize, 0x1000) )
                 if not newData:
                     break
+                message.appendData(newData)
+                missingSize    -= len(newData)
+                self.bytesRead += len(newData)
 ##            if missingSize > 0:
 ##                raise Exception, 'Connection closed by peer'
         return message
@@ -158,9 +336,211 @@ class StreamTransport(Transport):
 ##        if self.sock is None:
 ##            self.connect(self.address)
         data   = str(message)
-        print 'WRITING %r' % data                               # XXX
-        retval = self.sock.sendall(data)
-        return retval
+        log.debug('WRITING %r', data)
+        self.feed(data)
+        self.consume()
+
+#------------------------------------------------------------------------------
+
+class TLSStreamTransport(StreamTransport):
+    'TCP transport over TLS, for rtsps:// URLs'
+
+    defaultPort     = 322
+
+    # Contexts are shared by every transport, see configure().
+    serverContext   = None
+    clientContext   = None
+
+    # Limit the number of concurrent handshakes, they're CPU bound.
+    handshakeSlots  = BoundedSemaphore(16)
+
+    sendFlags       = 0     # SSL sockets don't take send flags, see sendSome
+
+    @classmethod
+    def configure(self, certfile = None, keyfile = None, cafile = None):
+        'Set up the shared server (if given a certificate) and client contexts.'
+        if ssl is None:
+            raise Exception, 'TLS is not supported by this Python build'
+        if certfile is not None:
+            context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            context.load_cert_chain(certfile, keyfile)
+            self.serverContext = context
+        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        if cafile is not None:
+            context.load_verify_locations(cafile)
+            context.verify_mode = ssl.CERT_REQUIRED
+        else:
+            context.verify_mode = ssl.CERT_NONE     # fuzz targets, anything goes
+        self.clientContext = context
+
+    def __init__(self, sock = None):
+        StreamTransport.__init__(self, sock)
+        self.handshakePending   = False
+        self.retrySize          = 0
+
+    def accept(self):
+        newTransport = StreamTransport.accept(self)
+        if newTransport is not None:
+            # Handshake later in the serve thread, not in the accept loop.
+            newTransport.handshakePending = True
+        return newTransport
+
+    def handshake(self):
+        'Do the server side handshake of an accepted connection.'
+        if self.serverContext is None:
+            raise Exception, 'No server certificate, call configure() first'
+        self.handshakeSlots.acquire()
+        try:
+            self.sock = self.serverContext.wrap_socket(self.sock,
+                                                        server_side = True)
+        finally:
+            self.handshakeSlots.release()
+        self.handshakePending = False
+
+    def connect(self, address):
+        if self.clientContext is None:
+            self.configure()
+        Transport.connect(self, address)
+        self.handshakeSlots.acquire()
+        try:
+            self.sock = self.clientContext.wrap_socket(self.sock,
+                                                server_hostname = address[0])
+        finally:
+            self.handshakeSlots.release()
+
+    def sendSome(self, data):
+        # SSL sockets ignore MSG_DONTWAIT, so the socket is made non blocking
+        # just for the send. After a partial record OpenSSL wants the same
+        # data again, so a retry never sends more than the last attempt.
+        if self.retrySize:
+            data = data[ : self.retrySize ]
+        sock    = self.sock
+        timeout = sock.gettimeout()
+        sock.settimeout(0.0)
+        try:
+            try:
+                count = sock.send(data)
+            except ssl.SSLError, e:
+                if e.args[0] not in (ssl.SSL_ERROR_WANT_WRITE,
+                                     ssl.SSL_ERROR_WANT_READ):
+                    raise
+                count = 0
+            except socket_error, e:
+                if e.args[0] not in (EAGAIN, EWOULDBLOCK):
+                    raise
+                count = 0
+        finally:
+            sock.settimeout(timeout)
+        if count:
+            self.retrySize = 0
+        else:
+            self.retrySize = len(data)
+        return count
+
+    def receive(self, size):
+        # Decrypted data may be waiting inside the SSL object, where select()
+        # can't see it, so only wait on the socket when there is none.
+        if self.sock.pending():
+            return self.sock.recv(size)
+        return StreamTransport.receive(self, size)
+
+    def read(self):
+        if self.handshakePending:
+            self.handshake()
+        return StreamTransport.read(self)
+
+    def write(self, message):
+        if self.handshakePending:
+            self.handshake()
+        return StreamTransport.write(self, message)
+
+#------------------------------------------------------------------------------
+
+# QuickTime style RTSP over HTTP tunnels: the client opens a GET connection
+# to receive RTSP responses and a POST connection where it sends base64
+# encoded RTSP requests, both with the same x-sessioncookie header.
+tunnelContentType = 'application/x-rtsp-tunnelled'
+
+def isTunnelRequest(message):
+    return message.isRequest() and isinstance(message, HTTPRequest) and \
+                                    message.get('x-sessioncookie') is not None
+
+class TunnelTransport(StreamTransport):
+    'RTSP tunneled over an HTTP GET/POST connection pair'
+
+    def __init__(self, getTransport, postTransport, pending = ''):
+        StreamTransport.__init__(self, postTransport.sock)
+        self.getTransport   = getTransport
+        self.postTransport  = postTransport
+        self.address        = getattr(postTransport, 'address', None)
+        self.encoded        = ''
+        self.decoded        = ''
+        self.feedEncoded(pending)
+
+    def feedEncoded(self, data):
+        self.encoded += ''.join(data.split())   # whitespace is not base64
+
+    def decode(self):
+        'Decode every complete base64 quad received so far.'
+        encoded = self.encoded
+        usable  = len(encoded) & ~3
+        if not usable:
+            return ''
+        block, self.encoded = encoded[:usable], encoded[usable:]
+        if '=' not in block:
+            return a2b_base64(block)
+        # Each request is encoded separately, so padding can show up in the
+        # middle of the stream. The decoder stops at padding, so split there.
+        parts = []
+        start = 0
+        while start < usable:
+            end = block.find('=', start)
+            if end < 0:
+                end = usable
+            else:
+                end = (end | 3) + 1             # end of the padded quad
+            parts.append( a2b_base64(block[start:end]) )
+            start = end
+        return ''.join(parts)
+
+    def receive(self, size):
+        while not self.decoded:
+            self.decoded = self.decode()
+            if self.decoded:
+                break
+            self.drain()
+            data = self.postTransport.receive(0x10000)
+            if not data:
+                return ''
+            self.feedEncoded(data)
+        data, self.decoded = self.decoded[:size], self.decoded[size:]
+        return data
+
+    def drain(self):
+        'Send the responses queued on the GET half while waiting for the POST.'
+        getTransport = self.getTransport
+        postSock     = self.postTransport.sock
+        while getTransport.writeQueue:
+            r, w, e = select( [postSock], [getTransport.sock], [] )
+            if w:
+                getTransport.consume()
+            if r:
+                break
+
+    def write(self, message):
+        self.getTransport.write(message)
+
+    def throttle(self):
+        self.getTransport.throttle()
+
+    def abort(self):
+        self.getTransport.abort()
+        self.postTransport.abort()
+
+    def close(self):
+        self.getTransport.close()
+        self.postTransport.close()
+        self.sock = None
 
 #------------------------------------------------------------------------------
 
@@ -169,6 +549,11 @@ class Server:
 
     userAgent = 'BaseStreamingServer'
 
+    # Unmatched halves of RTSP over HTTP tunnels are closed after this many
+    # seconds, and at most this many may be waiting for their partner.
+    tunnelTimeout       = 30.0
+    maxPendingTunnels   = 256
+
     def __init__(self, transportClass = StreamTransport,
                                     bindAddress = 'localhost', bindPort = 554):
         self.transportClass = transportClass
@@ -177,6 +562,16 @@ class Server:
         self.alive          = True
         self.debugging      = True  # False
         self.killEvent      = Event()
+        self.dateCache      = (None, None)
+        self.errorPages     = {}
+        self.metrics        = Metrics()     # None to disable
+        self.profiler       = None
+        self.serveThreads   = set()
+        self.tunnelling     = True      # accept RTSP over HTTP tunnels
+        self.tunnels        = {}        # cookie -> (expiry timer, halves)
+        self.tunnelLock     = Lock()
+        self.responseTemplates = {}
+        self.listener       = None
 
     def kill(self, timeout = None):
         self.alive = False
@@ -186,36 +581,180 @@ class Server:
     def spawn(self):
         start_new_thread(self.run, ())
 
+    def listen(self, reuseAddress = False):
+        'Bind the listener, run() does it unless it was done beforehand.'
+        self.listener = self.transportClass()
+        if reuseAddress:
+            self.listener.sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        self.listener.bind( (self.bindAddress, self.bindPort) )
+        self.listener.listen()
+
     def run(self):
         try:
-            self.listener = self.transportClass()
-            self.listener.bind( (self.bindAddress, self.bindPort) )
-            self.listener.listen()
+            if self.listener is None:
+                self.listen()
             while self.alive:
                 newTransport = self.listener.accept()
                 if self.alive:
-                    start_new_thread( self.serve, (newTransport,) )
+                    start_new_thread( self.serveThread, (newTransport,) )
 ##            self.listener.close()
         except:
             if self.debugging:
-                traceback.print_exc()
-                print
+                log.exception()
         self.killEvent.set()
 
+    def serveThread(self, transport):
+        'Thread entry point, keeps track of the threads running serve().'
+        ident = get_ident()
+        self.serveThreads.add(ident)
+        try:
+            self.serve(transport)
+        finally:
+            self.serveThreads.discard(ident)
+
+    def startProfiler(self, duration = 10, rate = 100, filename = None):
+        'Sample the serve threads for the given seconds.'
+        if self.profiler is not None and self.profiler.running:
+            raise Exception, 'Profiler already running'
+        if filename is None:
+            filename = 'profile-%d.folded' % time()
+        threads = lambda: list(self.serveThreads)
+        self.profiler = SamplingProfiler(threads, rate, filename)
+        self.profiler.start(duration)
+        return self.profiler
+
+    def installProfilerSignal(self, signum = None, duration = 10, rate = 100):
+        'Start the profiler when the signal is received (SIGUSR1 by default).'
+        if signum is None:
+            signum = signal.SIGUSR1
+        def handler(signum, frame):
+            try:
+                self.startProfiler(duration, rate)
+            except:
+                if self.debugging:
+                    log.exception()
+        return signal.signal(signum, handler)
+
+    serveStages = ('read', 'handler', 'write')
+
     def serve(self, transport):
+        metrics = self.metrics
+        transport.tunnelling = self.tunnelling
         try:
             while transport.sock is not None:
+                received, sent = transport.bytesRead, transport.bytesWritten
                 req  = transport.read()
-                name = 'do_%s' % req.getMethod()
+                if self.tunnelling and isTunnelRequest(req):
+                    return self.openTunnel(req, transport)
+                transport.throttle()
+                parsed = clock()
+                method = req.getMethod()
+                name = 'do_%s' % method
                 fn   = getattr(self, name, self.serveUnknown)
                 resp = fn(req, transport)
                 if not resp:
                     resp = self.buildErrorResponse(req, '500')
+                handled = clock()
                 transport.write(resp)
+                if metrics is not None:
+                    times = (transport.readStart, parsed, handled, clock())
+                    metrics.recordStages(method, self.serveStages, times)
+                    self.countTraffic(transport, received, sent, resp)
         except:
+            if metrics is not None:
+                metrics.increment('sessions.aborted')
             if self.debugging:
-                traceback.print_exc()
-                print
+                log.exception()
+
+    def countTraffic(self, transport, received, sent, resp = None):
+        metrics = self.metrics
+        metrics.increment('messages')
+        metrics.increment('bytes.in',  transport.bytesRead - received)
+        metrics.increment('bytes.out', transport.bytesWritten - sent)
+        if resp is not None:
+            metrics.countResponse(resp)
+
+    def serveMetrics(self, bindAddress = 'localhost', bindPort = 8554):
+        'Spawn a local HTTP server that publishes this server\'s metrics.'
+        server = MetricsServer(self, StreamTransport, bindAddress, bindPort)
+        server.debugging = self.debugging
+        server.spawn()
+        return server
+
+    def openTunnel(self, req, transport):
+        'Pair up the GET and POST halves of a tunnel, serve it when complete.'
+        method = req.getMethod()
+        if method == 'GET':
+            # Must go out before any tunneled RTSP response.
+            transport.write( self.buildTunnelResponse(req) )
+        elif method != 'POST':
+            transport.write( self.buildErrorResponse(req, '405') )
+            return
+        cookie   = req['x-sessioncookie']
+        replaced = None
+        complete = False
+        self.tunnelLock.acquire()
+        try:
+            entry = self.tunnels.get(cookie)
+            if entry is None and len(self.tunnels) >= self.maxPendingTunnels:
+                replaced = (req, transport)     # no room, drop this one
+            else:
+                if entry is None:
+                    halves = {}
+                    timer  = timers.wheel.schedule(self.tunnelTimeout,
+                                            self.expireTunnel, cookie, halves)
+                    entry  = (timer, halves)
+                    self.tunnels[cookie] = entry
+                timer, halves  = entry
+                replaced       = halves.get(method) # same cookie sent twice
+                halves[method] = (req, transport)
+                complete       = len(halves) == 2
+                if complete:
+                    del self.tunnels[cookie]
+                    timer.cancel()
+        finally:
+            self.tunnelLock.release()
+        if replaced is not None:
+            self.dropTunnelHalf(replaced[1], 'tunnels.dropped')
+        if not complete:
+            return                      # the other half will serve the tunnel
+        getTransport        = halves['GET'][1]
+        postReq, postTransport = halves['POST']
+        pending = postReq.getData() + postTransport.readBuffer
+        postTransport.readBuffer = ''
+        log.debug('TUNNEL OPEN %s', cookie)
+        self.serve( TunnelTransport(getTransport, postTransport, pending) )
+
+    def expireTunnel(self, cookie, halves):
+        'Timer callback, closes a tunnel half whose partner never came.'
+        self.tunnelLock.acquire()
+        try:
+            entry = self.tunnels.get(cookie)
+            if entry is None or entry[1] is not halves:
+                return                  # paired up while the timer fired
+            del self.tunnels[cookie]
+        finally:
+            self.tunnelLock.release()
+        for req, transport in halves.values():
+            self.dropTunnelHalf(transport, 'tunnels.expired')
+
+    def dropTunnelHalf(self, transport, counter):
+        transport.abort()       # don't linger flushing it, may be the timer
+        transport.close()
+        if self.metrics is not None:
+            self.metrics.increment(counter)
+
+    def buildTunnelResponse(self, req):
+        resp = req.makeResponse()
+        resp.setProtocol( req.getProtocol() )
+        resp.setStatus( '200' )
+        resp.setText( resp.supportedCodes['200'] )
+        resp['Server']          = self.userAgent
+        resp['Connection']      = 'close'
+        resp['Cache-Control']   = 'no-store'
+        resp['Pragma']          = 'no-cache'
+        resp['Content-Type']    = tunnelContentType
+        return resp
 
     def serveUnknown(self, req, transport):
         return self.buildErrorResponse(req, '405')
@@ -236,28 +775,91 @@ class Server:
             req['Session']      = session
         return req
 
+    def getDate(self):
+        'Formatted Date header value, recalculated at most once per second.'
+        now = int(time())
+        cached = self.dateCache
+        if cached[0] != now:
+            cached = (now, asctime(localtime(now)))
+            self.dateCache = cached
+        return cached[1]
+
+    def getResponseTemplate(self, req, status, optional):
+        'Prebuilt response and header layout for a (protocol, status) pair.'
+        key = (req.makeResponse, req.getProtocol(), status, optional,
+                                                                self.userAgent)
+        try:
+            return self.responseTemplates[key]
+        except KeyError:
+            pass
+        prototype = req.makeResponse()
+        prototype.setStatus( status )
+        prototype.setProtocol( req.getProtocol() )
+        prototype.setText( prototype.supportedCodes[ status ] )
+        hasCSeq, hasConnection, hasSession = optional
+        layout = []
+        if hasCSeq:
+            layout.append( ('CSeq', None) )
+        layout.append( ('Cache-Control', 'no-cache') )
+        layout.append( ('Content-length', None) )
+        layout.append( ('Date', None) )
+        layout.append( ('Expires', None) )
+        if hasConnection:
+            layout.append( ('Connection', None) )
+        if hasSession:
+            layout.append( ('Session', None) )
+        layout.append( ('Server', self.userAgent) )
+        separator = prototype.header_separator
+        rendered  = ''
+        for name, value in layout:
+            if value is None:
+                value = '%s'
+            else:
+                value = str(value).replace('%', '%%')
+            rendered += prototype.header_fmt % vars()
+            rendered += prototype.newline
+        rendered += prototype.newline
+        template = (prototype, tuple(layout), rendered)
+        self.responseTemplates[key] = template
+        return template
+
     def buildResponse(self, req, status = '200', data = ''):
-##        resp = RTSPResponse()
-        resp = req.makeResponse()
-        resp.setStatus( status )
-        resp.setProtocol( req.getProtocol() )
-        resp.setText( resp.supportedCodes[ resp.getStatus() ] )
+        cseq       = req.get('CSeq')
+        connection = req.get('Connection')
+        session    = req.get('Session')
+        optional   = (cseq is not None, connection is not None,
+                                                            session is not None)
+        prototype, layout, rendered = self.getResponseTemplate(req, status,
+                                                                    optional)
+        date  = self.getDate()
+        slots = [ len(data), date, date ]
+        if cseq is not None:
+            slots.insert(0, cseq)
+        if connection is not None:
+            slots.append(connection)
+        if session is not None:
+            slots.append(session)
+        headerList = []
+        index = 0
+        for name, value in layout:
+            if value is None:
+                value = slots[index]
+                index += 1
+            headerList.append( (name, value) )
+        resp = copy(prototype)
+        resp.load( headerList, rendered % tuple(slots) )
         resp.setData( data )
-        if req.has_key('Cseq'):
-            resp['CSeq']            = req['CSeq']
-        resp['Cache-Control']       = 'no-cache'
-        resp['Content-length']      = len( resp.getData() )
-        resp['Date']                = asctime()
-        resp['Expires']             = resp['Date']
-        if req.has_key('Connection'):
-            resp['Connection']      = req['Connection']
-        resp['Server']              = self.userAgent
         return resp
 
     def buildErrorResponse(self, req, status):
         if hasattr(req.makeResponse, 'errorPage'):          # XXX ugly hack
-            text = req.makeResponse.supportedCodes[status]
-            data = req.makeResponse.errorPage % vars()
+            key = (req.makeResponse, status)
+            try:
+                data = self.errorPages[key]
+            except KeyError:
+                text = req.makeResponse.supportedCodes[status]
+                data = req.makeResponse.errorPage % vars()
+                self.errorPages[key] = data
             return self.buildResponse(req, status, data)
         return self.buildResponse(req, status)
 
@@ -268,10 +870,34 @@ class Client(Server):
 
     userAgent = 'BaseStreamingClient'
 
+    harness = None          # TargetHarness for a local target, if any
+
     def connect(self, targetAddress, targetPort = 554):
+        self.targetAddress  = targetAddress
+        self.targetPort     = targetPort
         self.connection = self.transportClass()
         self.connection.connect( (targetAddress, targetPort) )
 
+    def reconnect(self):
+        self.disconnect()
+        self.connect(self.targetAddress, self.targetPort)
+
+    def exchange(self, req):
+        'Send a request and read the response, minding the target harness.'
+        harness = self.harness
+        if harness is not None and harness.begin():
+            self.reconnect()
+        try:
+            self.connection.write(req)
+            resp = self.connection.read()
+        except:
+            if harness is not None:
+                harness.end(str(req), True)
+            raise
+        if harness is not None:
+            harness.end(str(req))
+        return resp
+
     def disconnect(self):
         c = self.connection
         del self.connection
@@ -279,98 +905,491 @@ class Client(Server):
 
 #------------------------------------------------------------------------------
 
+class UpstreamDeadline:
+    'Deadlines for each phase of a proxied request, on a shared timer wheel'
+
+    def __init__(self, wheel, responseTimeout = None):
+        self.wheel              = wheel
+        self.responseTimeout    = responseTimeout
+        self.lock               = Lock()
+        self.generation         = 0
+        self.timer              = None
+        self.phase              = None
+        self.transport          = None
+        self.started            = None
+        self.expired            = None
+
+    def enter(self, phase, timeout, transport):
+        'Start a new phase, aborting the transport if it takes too long.'
+        self.finish()
+        if timeout is None:
+            return
+        self.lock.acquire()
+        try:
+            self.phase      = phase
+            self.transport  = transport
+            self.started    = clock()
+            self.timer      = self.wheel.schedule(timeout, self.expire,
+                                                            self.generation)
+        finally:
+            self.lock.release()
+
+    def finish(self):
+        'Disarm the current phase, return the phase that expired, if any.'
+        self.lock.acquire()
+        try:
+            self.generation += 1
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        finally:
+            self.lock.release()
+        return self.expired
+
+    def expire(self, generation):
+        self.lock.acquire()
+        try:
+            if generation != self.generation:
+                return                          # finished in the meantime
+            if self.phase == 'first byte' and \
+                                    self.transport.readStart >= self.started:
+                # The response has started, now wait for the rest of it.
+                if self.responseTimeout is None:
+                    return
+                remaining = self.started + self.responseTimeout - clock()
+                self.phase = 'complete'
+                if remaining > 0:
+                    self.timer = self.wheel.schedule(remaining, self.expire,
+                                                                    generation)
+                    return
+            self.expired     = self.phase
+            self.generation += 1
+            transport        = self.transport
+        finally:
+            self.lock.release()
+        transport.abort()
+
+#------------------------------------------------------------------------------
+
 class Proxy(Server):
     'Base class for streaming proxies'
 
     userAgent = 'BaseStreamingProxy'
 
+    # Upstream deadlines in seconds, None to disable.
+    connectTimeout      = 5.0       # establishing the upstream connection
+    firstByteTimeout    = 10.0      # from sending the request to the response
+    responseTimeout     = 30.0      # from sending the request to the end
+
     def __init__(self, transportClass = StreamTransport,
                                     bindAddress = 'localhost', bindPort = 554):
         Server.__init__(self, transportClass, bindAddress, bindPort)
         self.connectionDict = {}
+        self.timerWheel     = timers.wheel
+        self.timeoutLog     = deque(maxlen = 100)
+        self.responseCache  = None
+        self.coverage       = None
+        self.corpus         = None
+        self.harness        = None
+        self.anomalies      = None
+        self.messagePool    = None
+        self.hooks          = None      # HookTable, swapped by hookLoader
+        self.hookLoader     = None
+
+    # Response cache for requests the fuzzer doesn't mutate (disabled by
+    # default, see enableResponseCache). Responses are keyed on the method,
+    # the rewritten URL and the values of these request headers.
+    cacheableMethods    = ('OPTIONS', 'DESCRIBE')
+    cacheKeyHeaders     = (
+        'Accept',
+        'Accept-Encoding',
+        'Accept-Language',
+        'Authorization',
+        'Require',
+        'Session',
+    )
+
+    def enableResponseCache(self, ttl = 60.0, maxBytes = 0x100000,
+                                                            maxEntries = 1024):
+        self.responseCache = LRUCache(maxEntries, maxBytes, ttl)
+        return self.responseCache
+
+    def disableResponseCache(self):
+        self.responseCache = None
+
+    # Coverage feedback from an instrumented target (disabled by default, see
+    # enableCoverage). The bitmap is collected after each proxied exchange,
+    # so it only makes sense with one request in flight at a time.
+    def enableCoverage(self, bitmap, corpus = None):
+        if corpus is None:
+            corpus = Corpus()
+        self.coverage = CoverageMap(bitmap)
+        self.corpus   = corpus
+        return self.coverage
+
+    def disableCoverage(self):
+        self.coverage = None
+
+    def collectCoverage(self, req):
+        'Check the target bitmap, queue the request if it found something new.'
+        newBits = self.coverage.check()
+        if newBits:
+            self.corpus.add(str(req), newBits)
+            if self.metrics is not None:
+                self.metrics.increment('coverage.new')
+        return newBits
+
+    # Rare response fingerprints (disabled by default, see anomalies.py).
+    def enableAnomalyIndex(self, maxEntries = 0x10000, rareThreshold = 3,
+                                                            directory = None):
+        self.anomalies = AnomalyIndex(maxEntries, rareThreshold,
+                                                    directory = directory)
+        return self.anomalies
+
+    def disableAnomalyIndex(self):
+        self.anomalies = None
+
+    # Reuse message objects instead of allocating new ones (disabled by
+    # default). Requests and responses go back to the pool once written, so
+    # only enable it if the pre_ and post_ hooks don't keep them around.
+    def enableMessagePool(self, maxSize = 256):
+        self.messagePool = MessagePool(maxSize)
+        return self.messagePool
+
+    def disableMessagePool(self):
+        self.messagePool = None
+
+    # Local target run behind a fork server (see harness.py). Each client
+    # session is one test case with its own upstream connections, so the
+    # target is only recycled between sessions, and a session reconnects
+    # when its target crashed and was forked again. Enable it before serving.
+    def enableHarness(self, harness):
+        self.harness = harness
+        return harness
+
+    def disableHarness(self):
+        self.harness = None
+
+    # Hooks loaded from a module (see hooks.py), reloaded on the fly when the
+    # file changes or reloadHooks() is called, without dropping any session.
+    # The proxy's own pre_ and post_ methods cover what the module doesn't.
+    def enableHooks(self, filename, watch = True):
+        self.disableHooks()
+        loader = HookLoader(filename, self)
+        loader.load()
+        if watch:
+            loader.watch()
+        self.hookLoader = loader
+        return loader
+
+    def disableHooks(self):
+        if self.hookLoader is not None:
+            self.hookLoader.stop()
+        self.hookLoader = None
+        self.hooks      = None
+
+    def reloadHooks(self):
+        if self.hookLoader is None:
+            raise Exception, 'No hook module loaded'
+        return self.hookLoader.load()
+
+    def dropConnections(self, session = None):
+        'Close the upstream connections of one session, or every one of them.'
+        for key, connection in self.connectionDict.items():
+            if session is None or key[3:] == (session,):
+                connection.close()
+                self.connectionDict.pop(key, None)
+
+    def proxy_connect(self, req, deadline = None):
+        key = self.proxy_target(req)
+        return self.proxy_open(key, deadline)
 
-    def proxy_connect(self, req):
-##        url = req.getURL()
-        url = req.getPath()
-        host = urlsplit(url)[1]
-        if ':' in host:
-            connectAddress, connectPort = host.split(':')
+    # Upstream transport classes for URL schemes that need a specific one,
+    # anything else uses the same transport the proxy is listening on.
+    upstreamTransports  = {
+        'rtsps' : TLSStreamTransport,
+    }
+
+    def proxy_target(self, req):
+        'Get the upstream address and transport and rewrite the request URL.'
+        url = req.getParsedURL()
+        transportClass = self.upstreamTransports.get(url.scheme)
+        if transportClass is None:
+            transportClass = self.transportClass
+            defaultPort    = req.defaultPort
         else:
-            connectAddress, connectPort = host, req.defaultPort
-        connectPort = int(connectPort)
+            defaultPort    = transportClass.defaultPort
+        connectAddress, connectPort = url.getAddress(defaultPort)
         self.changeURL(req, connectAddress, connectPort)
-        key = (connectAddress, connectPort)
+        return (connectAddress, connectPort, transportClass)
+
+    def proxy_open(self, key, deadline = None):
+        'Get the upstream connection for an address, connecting if needed.'
+        connectAddress, connectPort, transportClass = key[:3]
         if self.connectionDict.has_key(key):
             connection = self.connectionDict[key]
             if connection.sock is None:
                 del self.connectionDict[key]
         if not self.connectionDict.has_key(key):
-            connection = self.transportClass()
-            connection.connect( (connectAddress, connectPort) )
+            connection = transportClass()
+            connection.messagePool = self.messagePool
+            if deadline is not None:
+                deadline.enter('connect', self.connectTimeout, connection)
+            try:
+                connection.connect( (connectAddress, connectPort) )
+            finally:
+                if deadline is not None:
+                    deadline.finish()
             self.connectionDict[key] = connection
         return connection
 
     def proxy(self, req):
+        deadline = UpstreamDeadline(self.timerWheel, self.responseTimeout)
+        cacheKey = None
+        harness  = None
+        outcome  = 'ok'
+        start    = clock()
         try:
-            connection = self.proxy_connect(req)
+            target = self.proxy_target(req)
+            cache  = self.responseCache
+            if cache is not None and req.getMethod() in self.cacheableMethods:
+                cacheKey = self.getCacheKey(req)
+                resp = cache.get(cacheKey)
+                if self.metrics is not None:
+                    self.metrics.increment(
+                            resp is None and 'cache.misses' or 'cache.hits')
+                if resp is not None:
+                    return self.cloneResponse(resp, req.get('CSeq'))
+            harness = self.harness
+            if harness is not None:
+                fork   = harness.resume()
+                target = target + (get_ident(),)    # not shared with others
+            connection = self.proxy_open(target, deadline)
+            if harness is not None:
+                if getattr(connection, 'targetFork', fork) != fork:
+                    connection.close()      # to a target that has crashed
+                    connection = self.proxy_open(target, deadline)
+                connection.targetFork = fork
             req.append( ('Via', self.userAgent) )
             if hasattr(req, 'getRelativeURL'):
                 req.setPath( req.getRelativeURL() )
-            connection.write(req)
-            resp = connection.read()
+            connection.lock.acquire()
+            try:
+                deadline.enter('first byte', self.firstByteTimeout, connection)
+                connection.write(req)
+                resp = connection.read()
+                if self.coverage is not None:
+                    self.collectCoverage(req)
+            finally:
+                if deadline.finish() is not None:
+                    connection.close()      # aborted, reconnect next time
+                connection.lock.release()
+            if harness is not None:
+                self.checkTarget(req, False)
+            if deadline.expired is not None:
+                outcome = 'timeout'                         # truncated
+                resp    = self.timeout(req, deadline.expired)
+            elif cacheKey is not None and resp.isResponse() and \
+                                                resp.getStatus() == '200':
+                cache.put(cacheKey, self.cloneResponse(resp), len(str(resp)))
         except:
-            if self.debugging:
-                traceback.print_exc()
-                print
-            resp = self.buildErrorResponse(req, '502')
+            if harness is not None:
+                self.checkTarget(req, True)
+            if deadline.expired is not None:
+                outcome = 'timeout'
+                resp    = self.timeout(req, deadline.expired)
+            else:
+                outcome = self.getErrorOutcome()
+                if self.metrics is not None:
+                    self.metrics.increment('errors.upstream')
+                if self.debugging:
+                    log.exception()
+                resp = self.buildErrorResponse(req, '502')
+        if self.anomalies is not None:
+            try:
+                self.anomalies.observe(req, resp, clock() - start, outcome)
+            except:
+                if self.debugging:      # never let it break forwarding
+                    log.exception()
         return resp
 
+    def getErrorOutcome(self):
+        'Classify the exception being handled for the anomaly index.'
+        error = sys.exc_info()[1]
+        if isinstance(error, socket_error):
+            return 'reset'
+        if str(error) == 'Connection closed by peer':
+            return 'closed'
+        return 'error'
+
+    def checkTarget(self, req, failed):
+        status = self.harness.check(str(req), failed)
+        if status is not None and self.metrics is not None:
+            self.metrics.increment('target.crashes')
+        return status
+
+    def getCacheKey(self, req):
+        values = tuple([ req.get(name) for name in self.cacheKeyHeaders ])
+        return (req.getMethod(), req.getURL(), values)
+
+    def cloneResponse(self, resp, cseq = None):
+        'Copy a response, optionally replacing its CSeq header.'
+        clone = copy(resp)
+        headerList = []
+        for name, value in resp:
+            if cseq is not None and name.lower() == 'cseq':
+                value = cseq
+            headerList.append( (name, value) )
+        clone.load(headerList)
+        return clone
+
+    def timeout(self, req, phase):
+        if self.metrics is not None:
+            self.metrics.increment('errors.timeout')
+        self.onTimeout(req, phase)
+        return self.buildErrorResponse(req, '504')
+
+    def onTimeout(self, req, phase):
+        'Called when the upstream misses a deadline, override to catch hangs.'
+        log.warning('UPSTREAM TIMEOUT (%s) ON %s', phase, req.getMethod())
+        self.timeoutLog.append( (time(), phase, str(req)) )
+
+    serveStages = ('read', 'pre', 'upstream', 'post', 'write')
+
     def serve(self, transport):
+        metrics = self.metrics
+        pool    = self.messagePool
+        transport.messagePool = pool
+        transport.tunnelling  = self.tunnelling
+        harness = self.harness
+        if harness is not None:
+            harness.begin()         # the whole session is one test case
         try:
             while transport.sock is not None:
+                received, sent = transport.bytesRead, transport.bytesWritten
                 req  = transport.read()
-                pre  = getattr(self, 'pre_%s' % req.getMethod(),  self.preUnknown)
-                post = getattr(self, 'post_%s' % req.getMethod(), self.postUnknown)
+                if self.tunnelling and isTunnelRequest(req):
+                    return self.openTunnel(req, transport)
+                transport.throttle()        # don't read upstream if stalled
+                times  = [transport.readStart, clock()]
+                method = req.getMethod()
+                hooks  = self.hooks     # picked up once per message
+                if hooks is None:
+                    pre  = getattr(self, 'pre_%s' % method,  self.preUnknown)
+                    post = getattr(self, 'post_%s' % method, self.postUnknown)
+                else:
+                    pre, post = hooks.lookup(self, method)
                 req  = pre(req, transport)
+                times.append( clock() )
+                resp = None
                 if req:
                     resp = self.proxy(req)
+                    times.append( clock() )
                     if resp:
                         resp = post(resp, transport)
+                        times.append( clock() )
                         if resp:
                             transport.write(resp)
+                            times.append( clock() )
                         else:
                             transport.close()
+                if metrics is not None:
+                    stages = self.serveStages[ : len(times) - 1 ]
+                    metrics.recordStages(method, stages, times)
+                    self.countTraffic(transport, received, sent, resp)
+                if pool is not None:
+                    if req is not None:
+                        pool.release(req)
+                    if resp is not None:
+                        pool.release(resp)
         except:
+            if metrics is not None:
+                metrics.increment('sessions.aborted')
             if self.debugging:
-                traceback.print_exc()
-                print
+                log.exception()
+        finally:
+            if harness is not None:
+                self.dropConnections( get_ident() )
+                if harness.end() is not None and metrics is not None:
+                    metrics.increment('target.crashes')
 
     def changeURL(self, req, connectAddress, connectPort):
-        url         = req.getURL()
-        pieces      = list( urlsplit(url) )
-        pieces[1]   = '%s:%d' % (connectAddress, connectPort)
-        url         = urlunsplit( tuple(pieces) )
-        req.setURL(url)
+        url     = req.getParsedURL()
+        netloc  = '%s:%d' % (connectAddress, connectPort)
+        if url.netloc != netloc:
+            url = url.replace(netloc = netloc)
+        req.setURL( url.geturl() )
         return req
 
     def preUnknown(self, req, transport):
-        if self.debugging:
-            print '-' * 79
-            print str(req)
-            print '-' * 79
+        if self.debugging and log.isEnabled(DEBUG):
+            log.debug(messageDump, str(req))
         return req
 
     def postUnknown(self, resp, transport):
-        if self.debugging:
-            print '-' * 79
-            print str(resp)
-            print '-' * 79
+        if self.debugging and log.isEnabled(DEBUG):
+            log.debug(messageDump, str(resp))
+        return resp
+
+#------------------------------------------------------------------------------
+
+class MetricsServer(Server):
+    'Publishes the metrics of another server over HTTP'
+
+    userAgent = 'BaseStreamingMetrics'
+
+    def __init__(self, source, transportClass = StreamTransport,
+                                bindAddress = 'localhost', bindPort = 8554):
+        Server.__init__(self, transportClass, bindAddress, bindPort)
+        self.source  = source
+        self.metrics = None
+
+    def do_GET(self, req, transport):
+        path, query = urlsplit( req.getPath() )[2:4]
+        status = '200'
+        if path in ('/', '/metrics'):
+            if self.source.metrics is None:
+                return self.buildErrorResponse(req, '400')
+            data = self.source.metrics.render()
+        elif path == '/profile':
+            params = dict([ x.split('=', 1) for x in query.split('&')
+                                                                if '=' in x ])
+            try:
+                duration = float( params.get('seconds', 10) )
+                rate     = int( params.get('rate', 100) )
+            except ValueError:
+                return self.buildErrorResponse(req, '400')
+            if not (duration > 0 and rate > 0):     # also catches NaN
+                return self.buildErrorResponse(req, '400')
+            try:
+                profiler = self.source.startProfiler(duration, rate)
+            except Exception:
+                return self.buildErrorResponse(req, '409')
+            data = 'Profiling for %s seconds into %s\n'
+            data = data % (duration, profiler.filename)
+        elif path in ('/hooks', '/hooks/reload'):
+            loader = getattr(self.source, 'hookLoader', None)
+            if loader is None:
+                return self.buildErrorResponse(req, '404')
+            if path == '/hooks/reload':
+                try:
+                    self.source.reloadHooks()
+                except Exception:
+                    status = '500'      # old hooks stay, lastError says why
+            stats = loader.stats()
+            data  = ''.join([ '%s %s\n' % (key, stats[key])
+                                                for key in sorted(stats) ])
+        else:
+            return self.buildErrorResponse(req, '404')
+        resp = self.buildResponse(req, status, data)
+        resp['Content-Type'] = 'text/plain'
         return resp
 
 #==============================================================================
 
 def testme():
     'Some rudimentary test code'
+    log.setLevel(DEBUG)
     print 'Running.'
     proxy_tcp = Proxy(StreamTransport,   'localhost', 5454)
     proxy_udp = Proxy(DatagramTransport, 'localhost', 5455)
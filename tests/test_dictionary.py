@@ -0,0 +1,53 @@
+# Tests for the token dictionary sketches
+# by Mario Vilas (mvilas at gmail.com)
+#
+# Run from the repository root:
+#   python -m unittest discover tests
+
+import unittest
+
+from dictionary import CountMinSketch, FrequencyTable
+
+#------------------------------------------------------------------------------
+
+class CountMinSketchTest(unittest.TestCase):
+
+    def collidingPair(self, sketch):
+        'Two same length tokens that land on the same index of the first row.'
+        seen = {}
+        for i in xrange(100000):
+            token = 'token%05d' % i
+            index = sketch.indexes(token)[0]
+            if index in seen:
+                return seen[index], token
+            seen[index] = token
+
+    def testRowsAreIndependent(self):
+        'Tokens colliding in one row still get separate estimates.'
+        sketch = CountMinSketch(width = 1024, depth = 4)
+        first, second = self.collidingPair(sketch)
+        sketch.add(first, 100)
+        self.assertEqual(sketch.estimate(first), 100)
+        self.assertEqual(sketch.estimate(second), 0)
+
+    def testMerge(self):
+        one, two = CountMinSketch(256, 4), CountMinSketch(256, 4)
+        one.add('OPTIONS', 3)
+        two.add('OPTIONS', 4)
+        one.merge(two)
+        self.assertEqual(one.estimate('OPTIONS'), 7)
+
+class FrequencyTableTest(unittest.TestCase):
+
+    def testTopTokens(self):
+        table = FrequencyTable(capacity = 2)
+        for token, count in (('a', 50), ('b', 30), ('c', 1)):
+            for i in xrange(count):
+                table.add(token)
+        for i in xrange(20):
+            table.add('noise%d' % i)
+        self.assertEqual([ token for token, count in table.items() ],
+                         ['a', 'b'])
+
+if __name__ == '__main__':
+    unittest.main()
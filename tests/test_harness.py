@@ -0,0 +1,147 @@
+# Tests for the fork server harness
+# by Mario Vilas (mvilas at gmail.com)
+#
+# Run from the repository root:
+#   python -m unittest discover tests
+
+import os
+import signal
+import socket
+import unittest
+
+from time import time, sleep
+
+from rtsp_server import Server, Client, Proxy, StreamTransport
+from harness import PythonForkServer, TargetHarness
+
+#------------------------------------------------------------------------------
+
+class DelayedCrashTarget:
+    'Stands in for a Server, dies a moment after it starts running.'
+
+    delay = 0.02
+
+    def listen(self, reuseAddress = False):
+        pass
+
+    def run(self):
+        sleep(self.delay)
+        os.kill(os.getpid(), signal.SIGSEGV)
+
+class CrashGraceTest(unittest.TestCase):
+
+    def setUp(self):
+        forkServer = PythonForkServer( DelayedCrashTarget() )
+        forkServer.close = lambda: None
+        self.harness = TargetHarness(forkServer)
+        self.harness.crashGrace = 1.0
+        self.harness.start()
+
+    def tearDown(self):
+        self.harness.stop()
+
+    def testLateCrashMissedWithoutWait(self):
+        'Without waiting a target that dies after answering looks alive.'
+        self.harness.begin()
+        self.assertEqual(self.harness.end('case'), None)
+
+    def testLateCrashCaughtWithWait(self):
+        'Waiting the crash grace period catches it.'
+        self.harness.begin()
+        status = self.harness.end('case', wait = True)
+        self.assertNotEqual(status, None)
+        self.assertTrue( os.WIFSIGNALED(status) )
+        self.assertEqual( os.WTERMSIG(status), signal.SIGSEGV )
+        self.assertEqual(self.harness.crashCount, 1)
+
+#------------------------------------------------------------------------------
+
+def freePort():
+    sock = socket.socket()
+    try:
+        sock.bind( ('127.0.0.1', 0) )
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+class PidServer(Server):
+    'Tells which forked copy of the target answered.'
+
+    def do_OPTIONS(self, req, transport):
+        resp = self.buildResponse(req)
+        resp['X-Pid'] = str( os.getpid() )
+        return resp
+
+class ProxySessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.targetPort = freePort()
+        target = PidServer(StreamTransport, '127.0.0.1', self.targetPort)
+        target.debugging = False
+        self.harness = TargetHarness(PythonForkServer(target),
+                                     ('127.0.0.1', self.targetPort), 1)
+        self.harness.start()
+        self.proxyPort = freePort()
+        self.proxy = Proxy(StreamTransport, '127.0.0.1', self.proxyPort)
+        self.proxy.debugging = False
+        self.proxy.enableHarness(self.harness)
+        self.proxy.listen()
+        self.proxy.spawn()
+        self.clients = []
+
+    def tearDown(self):
+        self.disconnect()
+        self.proxy.kill(1)
+        self.harness.stop()
+
+    def connect(self):
+        client = Client(StreamTransport)
+        client.debugging = False
+        client.connect('127.0.0.1', self.proxyPort)
+        client.cseq = 0
+        self.clients.append(client)
+        return client
+
+    def disconnect(self):
+        # The forked targets inherit these sockets, closing isn't enough.
+        for client in self.clients:
+            client.connection.abort()
+            client.connection.close()
+        self.clients = []
+
+    def targetPid(self, client):
+        client.cseq += 1
+        url = 'rtsp://127.0.0.1:%d/' % self.targetPort
+        resp = client.exchange( client.buildRequest('OPTIONS', url, '',
+                                                                client.cseq) )
+        self.assertEqual(resp.getStatus(), '200')
+        return resp['X-Pid']
+
+    def waitForSessions(self):
+        deadline = time() + 5
+        while self.harness.active and time() < deadline:
+            sleep(0.01)
+        self.assertEqual(self.harness.active, 0)
+
+    def testSessionKeepsItsTarget(self):
+        'Recycling waits for the end of the sessions using the target.'
+        first  = self.connect()
+        pid    = self.targetPid(first)
+        self.assertEqual(self.targetPid(first), pid)
+        second = self.connect()
+        self.assertEqual(self.targetPid(second), pid)
+        self.assertEqual(self.targetPid(first), pid)
+        self.assertEqual(self.targetPid(second), pid)
+        self.disconnect()
+        self.waitForSessions()
+        self.assertNotEqual(self.targetPid( self.connect() ), pid)
+
+    def testRestart(self):
+        'The fork server listens again on the same port after stop().'
+        pid = self.targetPid( self.connect() )
+        self.harness.stop()         # the target closes first, in TIME_WAIT
+        self.harness.start()
+        self.assertNotEqual(self.targetPid( self.connect() ), pid)
+
+if __name__ == '__main__':
+    unittest.main()
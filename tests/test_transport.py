@@ -0,0 +1,55 @@
+# Tests for the stream transport framing
+# by Mario Vilas (mvilas at gmail.com)
+#
+# Run from the repository root:
+#   python -m unittest discover tests
+
+import unittest
+
+from socket import socketpair
+
+from rtsp_server import StreamTransport
+
+#------------------------------------------------------------------------------
+
+class ContentLengthTest(unittest.TestCase):
+
+    def setUp(self):
+        self.peer, sock = socketpair()
+        self.transport  = StreamTransport(sock)
+
+    def tearDown(self):
+        self.peer.close()
+        self.transport.close()
+
+    def testNegativeContentLength(self):
+        'A negative Content-Length is read as no body at all.'
+        self.peer.sendall(
+            'OPTIONS rtsp://localhost/ RTSP/1.0\r\n'
+            'CSeq: 1\r\n'
+            'Content-Length: -5\r\n'
+            '\r\n'
+            'HELLO-WORLD'
+        )
+        message = self.transport.read()
+        self.assertEqual(message.getData(), '')
+        self.assertEqual(self.transport.readBuffer, 'HELLO-WORLD')
+
+    def testPipelinedMessages(self):
+        self.peer.sendall(
+            'OPTIONS rtsp://localhost/ RTSP/1.0\r\n'
+            'CSeq: 1\r\n'
+            'Content-Length: 5\r\n'
+            '\r\n'
+            'HELLO'
+            'OPTIONS rtsp://localhost/ RTSP/1.0\r\n'
+            'CSeq: 2\r\n'
+            '\r\n'
+        )
+        first  = self.transport.read()
+        second = self.transport.read()
+        self.assertEqual(first.getData(), 'HELLO')
+        self.assertEqual(second['CSeq'], '2')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+# Shared timer wheel
+# by Mario Vilas (mvilas at gmail.com)
+#
+# A hashed timing wheel: timers are hashed into a fixed number of slots by
+# their expiration tick, and a single background thread advances the wheel
+# one slot per tick, firing whatever is due. Scheduling and cancelling are
+# O(1), so thousands of in-flight deadlines cost no more than a list entry
+# each, and there is only ever one timer thread.
+#
+# Callbacks run in the wheel thread and must return quickly.
+
+from math import ceil
+from thread import start_new_thread
+from threading import Lock
+from time import sleep
+
+from metrics import clock
+from ringlog import log
+
+#------------------------------------------------------------------------------
+
+class Timer:
+    'Handle for a scheduled callback.'
+
+    def __init__(self, callback, args):
+        self.callback   = callback
+        self.args       = args
+        self.rounds     = 0
+        self.cancelled  = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class TimerWheel:
+    'Hashed timing wheel driven by a single thread.'
+
+    def __init__(self, tick = 0.01, size = 512):
+        self.tick       = tick
+        self.size       = size
+        self.slots      = [ [] for i in xrange(size) ]
+        self.current    = 0
+        self.lock       = Lock()
+        self.running    = False
+
+    def schedule(self, delay, callback, *args):
+        'Call callback(*args) after the given seconds, return a Timer.'
+        timer = Timer(callback, args)
+        ticks = max(1, int( ceil(delay / self.tick) ))
+        self.lock.acquire()
+        try:
+            timer.rounds = (ticks - 1) // self.size
+            index = (self.current + ticks) % self.size
+            self.slots[index].append(timer)
+            if not self.running:
+                self.running = True
+                start_new_thread(self.run, ())
+        finally:
+            self.lock.release()
+        return timer
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        nextTick = clock() + self.tick
+        while self.running:
+            delay = nextTick - clock()
+            if delay > 0:
+                sleep(delay)
+            # Catch up on every tick we missed, if we were late.
+            while clock() >= nextTick:
+                self.advance()
+                nextTick += self.tick
+
+    def advance(self):
+        'Move the wheel one tick forward and fire the timers that are due.'
+        due = []
+        self.lock.acquire()
+        try:
+            self.current = (self.current + 1) % self.size
+            keep = []
+            for timer in self.slots[self.current]:
+                if timer.cancelled:
+                    continue
+                if timer.rounds > 0:
+                    timer.rounds -= 1
+                    keep.append(timer)
+                else:
+                    due.append(timer)
+            self.slots[self.current] = keep
+        finally:
+            self.lock.release()
+        for timer in due:
+            if timer.cancelled:
+                continue
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                log.exception('Timer callback failed')
+
+    def pending(self):
+        'Number of timers still scheduled (including cancelled ones).'
+        return sum([ len(slot) for slot in self.slots ])
+
+#------------------------------------------------------------------------------
+
+# Shared timer wheel used by the proxies.
+wheel = TimerWheel()